@@ -1,68 +1,206 @@
-import asyncio
-import logging.config
 import os
-import ssl as ssl_module
 from datetime import datetime as dt
-from ssl import SSLContext
-from typing import Union
-
-import yaml
-from dotenv import load_dotenv
-
-from app.model import BULK_ACTION
-
-# Loading environment
-load_dotenv('config/.env')
-env = os.getenv('ENV')
-os.environ['ENV'] = env
-
-# log config
-with open('config/config.log.yaml', 'r') as f:
-    log_config = yaml.safe_load(f.read())
-    log_config['handlers']['info_file_handler']['filename'] = 'logs/info_{}.log'.format(dt.now().strftime('%Y-%m-%d'))
-    log_config['handlers']['error_file_handler']['filename'] = 'logs/errors_{}.log'.format(dt.now().strftime('%Y-%m-%d'))
-    logging.config.dictConfig(log_config)
-logger = logging.getLogger(__name__)
-
-app_config_env_path = 'config/config.dev.yaml' if env == 'development' else 'config/config.test.yaml' if env == 'test' else 'config/config.prod.yaml'
-
-
-# Loading configurations
-app_config_path = 'config/config.app.yaml'
-app_config_env_path = 'config/config.dev.yaml' if env == 'development' else 'config/config.test.yaml' if env == 'test' else 'config/config.prod.yaml'
-try:
-    with open(app_config_env_path, 'r') as f:
-        app_config_env = yaml.safe_load(f.read())
-    with open(app_config_path, 'r', encoding='utf-8') as f:
-        app_config = yaml.safe_load(f.read())
-except OSError as e:
-    raise Exception(f'Unable to open {e.filename}')
-
-# ssl config
-cert_path = app_config_env.get('ssl', {}).get('cert_path', None)
-key_path = app_config_env.get('ssl', {}).get('key_path', None)
-
-ssl: Union[bool, SSLContext] = False
-# if env in ('test', 'production'):
-#     sslcontext = ssl_module.create_default_context()
-#     sslcontext.load_cert_chain(cert_path, key_path)
-#     ssl = sslcontext
-
-# elasticsearch config
-base_es_url = app_config_env['elasticsearch']['url']
-es_hosts = app_config_env['elasticsearch']['hosts']
-es_auth_token = app_config_env['elasticsearch']['auth_token'] if 'auth_token' in app_config_env['elasticsearch'] else ''
-es_headers = app_config['elasticsearch']['headers']
-es_headers['Authorization'] = es_auth_token
-
-
-WORK_DIR = app_config['export']['absolute_path']
-FILE_EXTENSIONS = tuple(app_config['export']['file_extensions'])
-TIMESTAMP = dt.now().timestamp()
-try:
-    ACTION: BULK_ACTION = [ba for ba in BULK_ACTION if ba.value == app_config['export']['bulk_action']][0]
-except:
-    ACTION: BULK_ACTION = BULK_ACTION.INDEX
-
-
-asyncio.set_event_loop(asyncio.new_event_loop())
\ No newline at end of file
+from typing import TYPE_CHECKING, Any, Optional, Union
+
+from app.model import BULK_ACTION, READER_MODE, SPOOL_MODE
+
+if TYPE_CHECKING:
+    from ssl import SSLContext
+
+# settings are read on first access (from app import X) instead of on import of app, so importing
+# app.model or a helper has no side effects, the cli may call load_settings with another config dir first
+CONFIG_DIR = os.getenv('ST_CONFIG_DIR', 'config')
+settings_loaded = False
+
+
+def load_settings(config_dir: Optional[str]=None) -> None:
+    global settings_loaded
+    import logging.config
+    import socket
+    import yaml
+    from dotenv import load_dotenv
+    try:
+        from yaml import CSafeLoader as SafeLoader
+    except ImportError: # pyyaml built without libyaml
+        from yaml import SafeLoader
+    config_dir = config_dir or CONFIG_DIR
+    os.environ['ST_CONFIG_DIR'] = os.path.abspath(config_dir) # inherited by spawned reader workers
+
+    # Loading environment
+    load_dotenv(os.path.join(config_dir, '.env'))
+    env = os.getenv('ENV')
+    os.environ['ENV'] = env
+
+    # log config
+    with open(os.path.join(config_dir, 'config.log.yaml'), 'r') as f:
+        log_config = yaml.load(f.read(), Loader=SafeLoader)
+        log_config['handlers']['info_file_handler']['filename'] = 'logs/info_{}.log'.format(dt.now().strftime('%Y-%m-%d'))
+        log_config['handlers']['error_file_handler']['filename'] = 'logs/errors_{}.log'.format(dt.now().strftime('%Y-%m-%d'))
+        os.makedirs('logs', exist_ok=True)
+        logging.config.dictConfig(log_config)
+    logger = logging.getLogger(__name__)
+
+    app_config_env_path = os.path.join(config_dir, 'config.dev.yaml' if env == 'development' else 'config.test.yaml' if env == 'test' else 'config.prod.yaml')
+
+
+    # Loading configurations
+    app_config_path = os.path.join(config_dir, 'config.app.yaml')
+    app_config_env_path = os.path.join(config_dir, 'config.dev.yaml' if env == 'development' else 'config.test.yaml' if env == 'test' else 'config.prod.yaml')
+    try:
+        with open(app_config_env_path, 'r') as f:
+            app_config_env = yaml.load(f.read(), Loader=SafeLoader)
+        with open(app_config_path, 'r', encoding='utf-8') as f:
+            app_config = yaml.load(f.read(), Loader=SafeLoader)
+    except OSError as e:
+        raise Exception(f'Unable to open {e.filename}')
+
+    # ssl config
+    cert_path = app_config_env.get('ssl', {}).get('cert_path', None)
+    key_path = app_config_env.get('ssl', {}).get('key_path', None)
+
+    ssl: Union[bool, 'SSLContext'] = False
+    # if env in ('test', 'production'):
+    #     import ssl as ssl_module
+    #     sslcontext = ssl_module.create_default_context()
+    #     sslcontext.load_cert_chain(cert_path, key_path)
+    #     ssl = sslcontext
+
+    # elasticsearch config
+    base_es_url = app_config_env['elasticsearch']['url']
+    es_hosts = app_config_env['elasticsearch']['hosts']
+    es_auth_token = app_config_env['elasticsearch']['auth_token'] if 'auth_token' in app_config_env['elasticsearch'] else ''
+    es_headers = app_config['elasticsearch']['headers']
+    es_headers['Authorization'] = es_auth_token
+    es_pool_config = app_config['elasticsearch'].get('pool', None) or {}
+    es_circuit_breaker_config = app_config['elasticsearch'].get('circuit_breaker', None) or {}
+
+    # parsed workbook cache config
+    cache_config = app_config.get('cache', None) or {}
+    CACHE_ENABLED = bool(cache_config.get('enabled', False))
+    CACHE_DIR = cache_config.get('path', 'cache/')
+    CACHE_MAX_BYTES = int(cache_config.get('max_bytes', 5 * 1024 ** 3))
+
+    # local state (delta manifest, ...)
+    state_config = app_config.get('state', None) or {}
+    STATE_DIR = state_config.get('path', 'state/')
+    RECONCILE_WITH_ES = bool(state_config.get('reconcile_with_es', False)) # adopt files older than the last ES bulk on every run, a new ledger is once
+    DELTA_ENABLED = bool((app_config.get('delta', None) or {}).get('enabled', False))
+
+    WORK_DIR = app_config['export']['absolute_path']
+    FILE_EXTENSIONS = tuple(app_config['export']['file_extensions'])
+    RECURSIVE_SCAN = bool(app_config['export'].get('recursive', False))
+    TIMESTAMP = dt.now().timestamp()
+    try:
+        ACTION: BULK_ACTION = [ba for ba in BULK_ACTION if ba.value == app_config['export']['bulk_action']][0]
+    except:
+        ACTION: BULK_ACTION = BULK_ACTION.INDEX
+    try:
+        READER: READER_MODE = [rm for rm in READER_MODE if rm.value == app_config['export']['reader']][0]
+    except:
+        READER: READER_MODE = READER_MODE.PANDAS
+    READER_CHUNK_SIZE = int(app_config['export'].get('chunk_size', 10000))
+    READER_WORKERS = int(app_config['export'].get('workers', 0)) # > 1 parses files on a process pool
+    READER_READ_AHEAD = int(app_config['export'].get('read_ahead', 8)) # batches read ahead of the uploads
+    csv_config = app_config['export'].get('csv', None) or {}
+    CSV_ENCODINGS = list(csv_config.get('encodings', ['utf-8', 'cp1250'])) # tried in order unless the file has a bom
+    CSV_DELIMITER = csv_config.get('delimiter', None) # None detects it from the header line
+
+    # bulk config
+    bulk_config = app_config.get('bulk', None) or {}
+    BULK_MAX_BYTES = int(bulk_config.get('max_bytes', 10 * 1024 * 1024)) # keep below elasticsearch http.max_content_length
+    BULK_MAX_DOCS = int(bulk_config.get('max_docs', 5000))
+    BULK_MAX_IN_FLIGHT = int(bulk_config.get('max_in_flight', 4))
+    BULK_COMPRESSION = bulk_config.get('compression', None) # 'gzip' or None
+    BULK_COMPRESSION_LEVEL = int(bulk_config.get('compression_level', 6))
+    bulk_retry_config = bulk_config.get('retry', None) or {}
+    BULK_MAX_RETRIES = int(bulk_retry_config.get('max_retries', 3))
+    BULK_INITIAL_BACKOFF = float(bulk_retry_config.get('initial_backoff', 1)) # seconds, doubled on every retry
+    BULK_MAX_BACKOFF = float(bulk_retry_config.get('max_backoff', 30))
+    bulk_adaptive_config = bulk_config.get('adaptive', None) or {}
+    BULK_ADAPTIVE = bool(bulk_adaptive_config.get('enabled', False)) # max_bytes and max_in_flight are only starting points
+    BULK_TARGET_LATENCY = float(bulk_adaptive_config.get('target_latency', 2)) # seconds per bulk request
+    BULK_ADAPTIVE_MIN_BYTES = int(bulk_adaptive_config.get('min_bytes', 1024 * 1024))
+    BULK_ADAPTIVE_MAX_BYTES = int(bulk_adaptive_config.get('max_bytes', 50 * 1024 * 1024))
+    BULK_ADAPTIVE_MAX_IN_FLIGHT = int(bulk_adaptive_config.get('max_in_flight', 16))
+
+    # run metrics config
+    metrics_config = app_config.get('metrics', None) or {}
+    METRICS_ENABLED = bool(metrics_config.get('enabled', False))
+    METRICS_FORMAT = metrics_config.get('format', 'json') # 'json' or 'prometheus' (textfile collector)
+    METRICS_PATH = metrics_config.get('path', 'logs/metrics.json')
+    METRICS_ATTACH = bool(metrics_config.get('attach_to_result', False)) # per file metrics in st-data-indexer documents
+
+    # profiling config, ST_PROFILE=1 enables it without touching the config
+    profiling_config = app_config.get('profiling', None) or {}
+    PROFILING_ENABLED = os.getenv('ST_PROFILE', str(profiling_config.get('enabled', False))).lower() in ('1', 'true', 'yes')
+    PROFILING_PATH = os.getenv('ST_PROFILE_DIR', profiling_config.get('path', 'logs/profiles'))
+    PROFILING_TRACEMALLOC = bool(profiling_config.get('tracemalloc', True))
+    PROFILING_TRACEMALLOC_FRAMES = int(profiling_config.get('tracemalloc_frames', 1)) # deeper traces attribute module level allocations to imports, at a large cost
+    PROFILING_TOP = int(profiling_config.get('top', 25)) # allocations per stage in the tracemalloc report
+    PROFILING_RSS_INTERVAL = float(profiling_config.get('rss_interval', 0.2)) # seconds between rss samples
+
+    # spool config
+    spool_config = app_config.get('spool', None) or {}
+    try:
+        SPOOL: SPOOL_MODE = [sm for sm in SPOOL_MODE if sm.value == spool_config['mode']][0]
+    except:
+        SPOOL: SPOOL_MODE = SPOOL_MODE.OFF
+    SPOOL_DIR = spool_config.get('path', 'spool/')
+    SPOOL_COMPRESSION = spool_config.get('compression', None) # 'gzip' or None
+    SPOOL_COMPRESSION_LEVEL = int(spool_config.get('compression_level', 6))
+
+    # backfill config
+    backfill_config = app_config.get('backfill', None) or {}
+    BACKFILL_REFRESH_INTERVAL = str(backfill_config.get('refresh_interval', '-1'))
+    BACKFILL_REPLICAS = int(backfill_config.get('replicas', 0))
+    BACKFILL_CHECKPOINT = backfill_config.get('checkpoint', os.path.join(STATE_DIR, 'backfill.json'))
+
+    # cluster config, instances sharing WORK_DIR claim files through lease files, every instance keeps its own STATE_DIR
+    cluster_config = app_config.get('cluster', None) or {}
+    CLUSTER_ENABLED = bool(cluster_config.get('enabled', False))
+    CLUSTER_DIR = cluster_config.get('path', os.path.join(WORK_DIR, '.leases')) # must be shared by all instances
+    CLUSTER_LEASE_TTL = float(cluster_config.get('lease_ttl', 600)) # seconds without renewal until a lease can be taken over
+    CLUSTER_INSTANCE = str(cluster_config.get('instance', f'{socket.gethostname()}-{os.getpid()}'))
+
+    # watch mode config
+    watch_config = app_config.get('watch', None) or {}
+    WATCH_DEBOUNCE = float(watch_config.get('debounce', 10)) # seconds a file has to stay unchanged
+    WATCH_POLL_INTERVAL = float(watch_config.get('poll_interval', 30))
+    WATCH_RETRY_INTERVAL = float(watch_config.get('retry_interval', 300)) # for files which failed in this process
+
+    # only the settings become attributes of app, modules and temporaries of this function stay local
+    settings = locals()
+    globals().update({name: settings[name] for name in (
+        'ssl', 'base_es_url', 'es_hosts', 'es_headers', 'es_pool_config', 'es_circuit_breaker_config'
+        ,'CACHE_ENABLED', 'CACHE_DIR', 'CACHE_MAX_BYTES'
+        ,'STATE_DIR', 'RECONCILE_WITH_ES', 'DELTA_ENABLED'
+        ,'WORK_DIR', 'FILE_EXTENSIONS', 'RECURSIVE_SCAN', 'TIMESTAMP', 'ACTION', 'READER'
+        ,'READER_CHUNK_SIZE', 'READER_WORKERS', 'READER_READ_AHEAD', 'CSV_ENCODINGS', 'CSV_DELIMITER'
+        ,'BULK_MAX_BYTES', 'BULK_MAX_DOCS', 'BULK_MAX_IN_FLIGHT', 'BULK_COMPRESSION', 'BULK_COMPRESSION_LEVEL'
+        ,'BULK_MAX_RETRIES', 'BULK_INITIAL_BACKOFF', 'BULK_MAX_BACKOFF'
+        ,'BULK_ADAPTIVE', 'BULK_TARGET_LATENCY', 'BULK_ADAPTIVE_MIN_BYTES', 'BULK_ADAPTIVE_MAX_BYTES', 'BULK_ADAPTIVE_MAX_IN_FLIGHT'
+        ,'METRICS_ENABLED', 'METRICS_FORMAT', 'METRICS_PATH', 'METRICS_ATTACH'
+        ,'PROFILING_ENABLED', 'PROFILING_PATH', 'PROFILING_TRACEMALLOC', 'PROFILING_TRACEMALLOC_FRAMES', 'PROFILING_TOP'
+        ,'PROFILING_RSS_INTERVAL'
+        ,'SPOOL', 'SPOOL_DIR', 'SPOOL_COMPRESSION', 'SPOOL_COMPRESSION_LEVEL'
+        ,'BACKFILL_REFRESH_INTERVAL', 'BACKFILL_REPLICAS', 'BACKFILL_CHECKPOINT'
+        ,'CLUSTER_ENABLED', 'CLUSTER_DIR', 'CLUSTER_LEASE_TTL', 'CLUSTER_INSTANCE'
+        ,'WATCH_DEBOUNCE', 'WATCH_POLL_INTERVAL', 'WATCH_RETRY_INTERVAL'
+    )})
+    settings_loaded = True
+
+
+def __getattr__(name: str) -> Any:
+    if name.startswith('__') or settings_loaded:
+        raise AttributeError(f"module 'app' has no attribute '{name}'")
+    load_settings()
+    if name not in globals():
+        raise AttributeError(f"module 'app' has no attribute '{name}'")
+    return globals()[name]
+
+
+def renew_timestamp() -> float:
+    # watch mode starts every ingest cycle as a new bulk
+    global TIMESTAMP
+    TIMESTAMP = dt.now().timestamp()
+    return TIMESTAMP
@@ -0,0 +1,85 @@
+import logging
+from typing import Dict
+
+from app import (BULK_ADAPTIVE, BULK_ADAPTIVE_MAX_BYTES, BULK_ADAPTIVE_MAX_IN_FLIGHT,
+                 BULK_ADAPTIVE_MIN_BYTES, BULK_MAX_BYTES, BULK_MAX_IN_FLIGHT, BULK_TARGET_LATENCY)
+from app.apis.pool import es_pool
+
+logger = logging.getLogger(__name__)
+
+
+# AIMD tuning of batch size and requests in flight from round trip times and rejections of bulk requests,
+# with adaptive sizing disabled it only keeps the statistics for the run summary; one overload burst is seen
+# by every request in flight, so only responses to requests sent after the last decrease decrease again
+class BulkController():
+    def __init__(self, adaptive: bool, batch_bytes: int, max_in_flight: int, target_latency: float
+                 , min_bytes: int, max_bytes: int, in_flight_limit: int) -> None:
+        self.adaptive = adaptive
+        self.batch_bytes = batch_bytes
+        self.max_in_flight = max_in_flight
+        self.target_latency = target_latency
+        self.min_bytes = min_bytes
+        self.max_bytes = max_bytes
+        self.in_flight_limit = in_flight_limit
+        self.step_bytes = max(min_bytes // 2, 256 * 1024)
+        self.n_requests = 0
+        self.n_documents = 0
+        self.n_rejected = 0
+        self.rtt_avg: float = None # exponential moving averages, seconds
+        self.took_avg: float = None
+        self.n_increases = 0
+        self.n_sent = 0
+        self.decreased_at = 0 # n_sent at the last decrease
+
+    def send(self) -> int:
+        # sequence number of a new request, passed back to observe with its response
+        self.n_sent += 1
+        return self.n_sent
+
+    def observe(self, rtt: float, took_ms: float, n_items: int, n_rejected: int, sent: int) -> None:
+        self.n_requests += 1
+        self.n_documents += n_items
+        self.n_rejected += n_rejected
+        self.rtt_avg = rtt if self.rtt_avg is None else 0.8 * self.rtt_avg + 0.2 * rtt
+        took = (took_ms or 0) / 1000
+        self.took_avg = took if self.took_avg is None else 0.8 * self.took_avg + 0.2 * took
+        if not self.adaptive:
+            return
+        if n_rejected or rtt > 1.5 * self.target_latency: # multiplicative decrease, once per window
+            if sent <= self.decreased_at:
+                return
+            self.decreased_at = self.n_sent
+            self.batch_bytes = max(self.min_bytes, self.batch_bytes // 2)
+            self.max_in_flight = max(1, self.max_in_flight // 2)
+            self.n_increases = 0
+            logger.info(f'Bulk backoff: batch {self.batch_bytes} B, {self.max_in_flight} in flight '
+                        f'(rtt {rtt:.2f}s, took {took:.2f}s, rejected {n_rejected}/{n_items})')
+        elif rtt < self.target_latency: # additive increase, concurrency grows once per window of successes
+            self.batch_bytes = min(self.max_bytes, self.batch_bytes + self.step_bytes)
+            self.n_increases += 1
+            if self.n_increases >= self.max_in_flight and self.max_in_flight < self.in_flight_limit:
+                self.max_in_flight += 1
+                self.n_increases = 0
+
+    def summary(self) -> Dict:
+        return {
+            'adaptive': self.adaptive
+            ,'batch_bytes': self.batch_bytes
+            ,'max_in_flight': self.max_in_flight
+            ,'requests': self.n_requests
+            ,'documents': self.n_documents
+            ,'rejected': self.n_rejected
+            ,'rtt_avg': None if self.rtt_avg is None else round(self.rtt_avg, 3)
+            ,'took_avg': None if self.took_avg is None else round(self.took_avg, 3)
+        }
+
+
+bulk_controller = BulkController(adaptive=BULK_ADAPTIVE
+                                 , batch_bytes=BULK_MAX_BYTES
+                                 , max_in_flight=BULK_MAX_IN_FLIGHT
+                                 , target_latency=BULK_TARGET_LATENCY
+                                 , min_bytes=BULK_ADAPTIVE_MIN_BYTES
+                                 , max_bytes=BULK_ADAPTIVE_MAX_BYTES
+                                 # more requests than connections would wait in the connector and count as latency
+                                 , in_flight_limit=min([BULK_ADAPTIVE_MAX_IN_FLIGHT] + [limit for limit in
+                                                       (es_pool.limit, es_pool.limit_per_host) if limit > 0]))
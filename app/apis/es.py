@@ -1,13 +1,24 @@
+import asyncio
+import gzip
 import json
 import logging
-import aiohttp
-from typing import Union
+import random
+import time
+from typing import Dict, List, Tuple, Union
+from app import (BULK_COMPRESSION, BULK_COMPRESSION_LEVEL, BULK_INITIAL_BACKOFF,
+                 BULK_MAX_BACKOFF, BULK_MAX_RETRIES)
+from app.apis.controller import bulk_controller
 from app.model import ESData, BulkResult, File
 from app.utils.decorators.es import use_multiple_es_hosts
+from app.utils.metrics import run_metrics
+from app.utils.profiling import profiled
 from .utils.helpers import parse_bulk_result
+from .utils.ndjson import dumps, loads
 
 logger = logging.getLogger(__name__)
 
+RETRYABLE_STATUSES = (429, 503) # es_rejected_execution_exception, unavailable shards
+
 
 @use_multiple_es_hosts
 async def get_last_indexed_timestamp(es: ESData) -> Union[float, None]:
@@ -16,9 +27,8 @@ async def get_last_indexed_timestamp(es: ESData) -> Union[float, None]:
         body = json.load(f)
 
     url = f'{es.url}/st-data-indexer/_search'
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, headers=es.headers, json=body, ssl=es.ssl) as resp:
-            data = await resp.json()
+    async with es.session.post(url, headers=es.headers, json=body, ssl=es.ssl) as resp:
+        data = await resp.json()
     
     if not (data and 'hits' in data and 'hits' in data['hits'] and data['hits']['hits'] and len(data['hits']['hits']) > 0):
         return None
@@ -26,23 +36,113 @@ async def get_last_indexed_timestamp(es: ESData) -> Union[float, None]:
 
 
 @use_multiple_es_hosts
-async def post_bulk_result(es: ESData, bulk_result: BulkResult) -> bool:
-    body = bulk_result.serialize()
-    url = f'{es.url}/st-data-indexer/_doc'
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, headers=es.headers, json=body, ssl=es.ssl) as resp:
-            data = await resp.json()
-    if data and 'result' in data and data['result'] == 'created':
-        return True
+async def post_bulk_results(es: ESData, bulk_results: List[BulkResult]) -> bool:
+    # results of all files of the run in one request, only results rejected by overloaded nodes are sent again
+    url = f'{es.url}/st-data-indexer/_bulk'
+    headers = {**es.headers, 'Content-Type': 'application/x-ndjson'}
+    for n_retries in range(BULK_MAX_RETRIES + 1):
+        if n_retries:
+            await asyncio.sleep(random.uniform(0, min(BULK_MAX_BACKOFF, BULK_INITIAL_BACKOFF * 2 ** (n_retries - 1))))
+        body = b''.join(b'{"index":{}}\n' + dumps(bulk_result.serialize()) + b'\n' for bulk_result in bulk_results)
+        async with es.session.post(url, headers=headers, data=body, ssl=es.ssl) as resp:
+            data = await resp.json(loads=loads)
+        items = data.get('items', None) if data else None
+        if not (isinstance(items, list) and len(items) == len(bulk_results)):
+            return False
+        rejected = [r for r, item in zip(bulk_results, items) if __item_status(item) in RETRYABLE_STATUSES]
+        if len(rejected) + sum(next(iter(item.values()), {}).get('result', None) == 'created' for item in items) < len(items):
+            return False
+        if not rejected:
+            return True
+        bulk_results = rejected
     return False
 
 
 @use_multiple_es_hosts
-async def bulk(es: ESData, bulk_data: str, file: File, n_items: int) -> BulkResult:
+async def get_index_settings(es: ESData, index: str, names: Tuple[str, ...]) -> Dict[str, Dict]:
+    # concrete index name -> flat settings, an alias resolves to all of its indices, {} for a missing index
+    url = f'{es.url}/{index}/_settings/{",".join(names)}'
+    async with es.session.get(url, headers=es.headers, params={'flat_settings': 'true'}, ssl=es.ssl) as resp:
+        data = await resp.json()
+    if not data or 'error' in data:
+        return {}
+    return {name: item.get('settings', {}) for name, item in data.items() if isinstance(item, dict)}
+
+
+@use_multiple_es_hosts
+async def put_index_settings(es: ESData, index: str, settings: Dict) -> bool:
+    # None values reset a setting to its default
+    url = f'{es.url}/{index}/_settings'
+    async with es.session.put(url, headers=es.headers, json=settings, ssl=es.ssl) as resp:
+        data = await resp.json()
+    return bool(data and data.get('acknowledged', False))
+
+
+@use_multiple_es_hosts
+async def refresh_index(es: ESData, index: str) -> bool:
+    url = f'{es.url}/{index}/_refresh'
+    async with es.session.post(url, headers=es.headers, ssl=es.ssl) as resp:
+        data = await resp.json()
+    return bool(data and '_shards' in data)
+
+
+@use_multiple_es_hosts
+async def bulk(es: ESData, bulk_data: bytes, file: File, n_items: int) -> BulkResult:
     url = f'{es.url}/{file.source.value.get("index")}/_bulk'
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, headers=es.headers, data=bulk_data, ssl=es.ssl) as resp:
-            data = await resp.json()
-    bulk_result = parse_bulk_result(data, file, n_items)
+    sent = bulk_controller.send()
+    data, rtt = await __post_bulk(es, url, bulk_data, file)
+    lines = None
+    n_retries = 0
+    while True:
+        if isinstance(data.get('items', None), list):
+            # only items rejected by overloaded nodes are sent again, keyed by their position in the body
+            positions = [i for i, item in enumerate(data['items']) if __item_status(item) in RETRYABLE_STATUSES]
+        else:
+            positions = list(range(n_items)) if data.get('status', None) in RETRYABLE_STATUSES else []
+        if n_retries == 0:
+            bulk_controller.observe(rtt, data.get('took', 0), n_items, len(positions), sent)
+        if not positions or n_retries >= BULK_MAX_RETRIES: break
+        await asyncio.sleep(random.uniform(0, min(BULK_MAX_BACKOFF, BULK_INITIAL_BACKOFF * 2 ** n_retries)))
+        n_retries += 1
+        if lines is None:
+            lines = bulk_data.split(b'\n')
+        retry_body = b''.join(lines[2 * i] + b'\n' + lines[2 * i + 1] + b'\n' for i in positions)
+        logger.warning(f'Retrying {len(positions)} rejected documents of file {file.name}, attempt {n_retries}')
+        retry_data, _ = await __post_bulk(es, url, retry_body, file, retry=True)
+        retry_items = retry_data.get('items', None)
+        if not isinstance(retry_items, list) or len(retry_items) != len(positions):
+            continue # rejected as a whole again
+        if not isinstance(data.get('items', None), list):
+            data = {'took': 0, 'items': [None] * n_items}
+        for i, item in zip(positions, retry_items):
+            data['items'][i] = item
+        data['took'] = data.get('took', 0) + retry_data.get('took', 0)
+        data['errors'] = any('error' in next(iter(item.values()), {}) for item in data['items'])
+    with profiled('parse'):
+        bulk_result = parse_bulk_result(data, file, n_items)
+    bulk_result.n_retries = n_retries
     return bulk_result
-        
\ No newline at end of file
+
+
+async def __post_bulk(es: ESData, url: str, bulk_data: bytes, file: File, retry: bool=False) -> Tuple[Dict, float]:
+    headers = {**es.headers, 'Content-Type': 'application/x-ndjson', 'Accept-Encoding': 'gzip'}
+    if BULK_COMPRESSION == 'gzip':
+        with profiled('encode'):
+            bulk_data = gzip.compress(bulk_data, compresslevel=BULK_COMPRESSION_LEVEL)
+        headers['Content-Encoding'] = 'gzip'
+    begin = time.monotonic()
+    async with es.session.post(url, headers=headers, data=bulk_data, ssl=es.ssl) as resp:
+        try:
+            data = await resp.json(loads=loads, content_type=None) or {}
+        except ValueError: # e.g. html body of a 413 from a proxy
+            data = {}
+        if not isinstance(data, dict):
+            data = {}
+        data.setdefault('status', resp.status) # whole request rejected, e.g. 429 without a json body
+    rtt = time.monotonic() - begin
+    run_metrics.observe_request(es.url, file, rtt, data.get('took', 0), len(bulk_data), retry)
+    return data, rtt
+
+
+def __item_status(item: Dict) -> Union[int, None]:
+    return next(iter(item.values()), {}).get('status', None)
@@ -0,0 +1,57 @@
+import logging
+import time
+from typing import List
+
+from app import (base_es_url, es_circuit_breaker_config, es_hosts)
+
+logger = logging.getLogger(__name__)
+
+
+class ESHost():
+    def __init__(self, url: str) -> None:
+        self.url = url
+        self.outstanding = 0 # requests in flight
+        self.failures = 0 # consecutive connection failures
+        self.open_until = 0.0 # circuit is open (host skipped) until this monotonic time
+
+
+# spreads calls over all healthy hosts (least outstanding requests, round robin on ties), hosts failing
+# to connect are skipped until their circuit half-opens again, state is kept for the lifetime of the process
+class ESHostPool():
+    def __init__(self, urls: List[str], failure_threshold: int, reset_timeout: float, max_reset_timeout: float) -> None:
+        self.hosts = [ESHost(url) for url in urls]
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.next = 0
+
+    def candidates(self) -> List[ESHost]:
+        # every host at most once per call, hosts with open circuits only as the last resort
+        now = time.monotonic()
+        n = len(self.hosts)
+        start = self.next
+        self.next = (self.next + 1) % n
+        available = [host for host in self.hosts if host.open_until <= now]
+        available.sort(key=lambda host: (host.outstanding, (self.hosts.index(host) - start) % n))
+        unavailable = sorted((host for host in self.hosts if host.open_until > now), key=lambda host: host.open_until)
+        return available + unavailable
+
+    def mark_success(self, host: ESHost) -> None:
+        if host.failures >= self.failure_threshold:
+            logger.info(f'Elasticsearch host {host.url} is reachable again')
+        host.failures = 0
+        host.open_until = 0.0
+
+    def mark_failure(self, host: ESHost) -> None:
+        host.failures += 1
+        if host.failures >= self.failure_threshold:
+            # re-probed after reset_timeout, doubled with every failed probe
+            timeout = min(self.max_reset_timeout, self.reset_timeout * 2 ** (host.failures - self.failure_threshold))
+            host.open_until = time.monotonic() + timeout
+            logger.warning(f'Elasticsearch host {host.url} skipped for {timeout:.0f}s')
+
+
+es_host_pool = ESHostPool(urls=es_hosts if es_hosts and isinstance(es_hosts, list) else [base_es_url]
+                          , failure_threshold=int(es_circuit_breaker_config.get('failure_threshold', 1))
+                          , reset_timeout=float(es_circuit_breaker_config.get('reset_timeout', 30))
+                          , max_reset_timeout=float(es_circuit_breaker_config.get('max_reset_timeout', 300)))
@@ -0,0 +1,49 @@
+import logging
+from typing import TYPE_CHECKING, Dict, Union
+
+from app import es_pool_config
+
+if TYPE_CHECKING:
+    import aiohttp
+
+logger = logging.getLogger(__name__)
+
+
+# one keep-alive session shared by all elasticsearch calls, created lazily inside the running event loop
+# and closed by the service layer once the run is over, aiohttp is imported with the first session
+class ESConnectionPool():
+    def __init__(self, limit: int, limit_per_host: int, keepalive_timeout: float
+                 , dns_cache_ttl: int, timeout: Dict) -> None:
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.timeout = timeout
+        self._session: Union['aiohttp.ClientSession', None] = None
+
+    @property
+    def session(self) -> 'aiohttp.ClientSession':
+        if self._session is None or self._session.closed:
+            import aiohttp
+            connector = aiohttp.TCPConnector(limit=self.limit
+                                             , limit_per_host=self.limit_per_host
+                                             , keepalive_timeout=self.keepalive_timeout
+                                             , use_dns_cache=True
+                                             , ttl_dns_cache=self.dns_cache_ttl)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(**self.timeout))
+        return self._session
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+timeout_config = es_pool_config.get('timeout', None) or {}
+es_pool = ESConnectionPool(limit=int(es_pool_config.get('limit', 20))
+                           , limit_per_host=int(es_pool_config.get('limit_per_host', 8))
+                           , keepalive_timeout=float(es_pool_config.get('keepalive_timeout', 60))
+                           , dns_cache_ttl=int(es_pool_config.get('dns_cache_ttl', 300))
+                           , timeout={'total': timeout_config.get('total', 300)
+                                      , 'connect': timeout_config.get('connect', 10)
+                                      , 'sock_read': timeout_config.get('sock_read', None)})
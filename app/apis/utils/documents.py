@@ -0,0 +1,118 @@
+import hashlib
+import logging
+import sqlite3
+from datetime import datetime as dt
+from typing import Any, Dict, Iterator, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from app import ACTION, BULK_MAX_DOCS
+from app.model import NULL_VALUES, File
+from app.apis.controller import bulk_controller
+from app.apis.utils.ndjson import BulkBodyBuilder, dumps
+from app.services.manifest import stage_changed_documents
+from app.utils.metrics import timed, timed_iter
+
+# frames to ndjson bulk bodies, split from helpers so pandas is only imported once files are read
+logger = logging.getLogger(__name__)
+
+
+def normalize_frame(df: pd.DataFrame, file: File) -> Iterator[Tuple[str, Dict]]:
+    # yields (source _id, document) for every valid row of the frame, whole columns are normalized at once
+    if file.id_field not in df.columns: return
+    ids = df[file.id_field]
+    mask = ids.notna() & ids.astype(bool)
+    if file.row_validator is not None:
+        mask &= file.row_validator(df)
+    df = df[mask]
+    if df.empty: return
+    ids = df[file.id_field].astype(str)
+    keys = [' '.join(key.strip().split()) for key in df.columns]
+    columns = [normalize_column(key, df.iloc[:, i], file) for i, key in enumerate(df.columns)]
+    for _id, values in zip(ids, zip(*columns)):
+        yield _id, dict(zip(keys, values)) # @uid is added by BulkBodyBuilder
+
+
+def normalize_column(key: str, values: pd.Series, file: File) -> np.ndarray:
+    nulls = values.isna() | values.isin(NULL_VALUES)
+    timestamps = ~nulls & __datetime_cells(values)
+    normalized = values.to_numpy(dtype=object, copy=True)
+    if timestamps.any():
+        normalized[timestamps.to_numpy()] = format_timestamps(values[timestamps])
+    if file.normalizer:
+        others = (~nulls & ~timestamps).to_numpy()
+        if others.any():
+            normalized[others] = file.normalizer(key, values[others]).to_numpy(dtype=object)
+    normalized[nulls.to_numpy()] = None
+    return normalized
+
+
+def __datetime_cells(values: pd.Series) -> pd.Series:
+    # cells are only checked one by one in columns mixing datetimes with other types
+    inferred = pd.api.types.infer_dtype(values, skipna=True)
+    if inferred in ('datetime', 'datetime64'):
+        return pd.Series(True, index=values.index)
+    if inferred.startswith('mixed') or inferred == 'date': # datetime is a subclass of date
+        return values.map(lambda value: isinstance(value, dt))
+    return pd.Series(False, index=values.index)
+
+
+def format_timestamps(values: pd.Series) -> np.ndarray:
+    # datetime.isoformat() for whole columns, microseconds only where non zero
+    try:
+        stamps = pd.to_datetime(values.astype(object))
+        if stamps.dt.tz is not None: raise ValueError('timezone aware timestamps')
+    except (ValueError, TypeError, OverflowError):
+        return values.map(lambda value: value.isoformat()).to_numpy(dtype=object)
+    if (stamps.dt.nanosecond != 0).any(): # not in excel files, isoformat prints nanoseconds
+        return values.map(lambda value: value.isoformat()).to_numpy(dtype=object)
+    instants = stamps.to_numpy('datetime64[us]')
+    formatted = np.datetime_as_string(instants, unit='s').astype(object)
+    fractional = (stamps.dt.microsecond != 0).to_numpy()
+    if fractional.any():
+        formatted[fractional] = np.datetime_as_string(instants[fractional], unit='us')
+    return formatted
+
+
+def build_bulk_batches(data: Iterator[pd.DataFrame], file: File
+                       , manifest: Optional[sqlite3.Connection]=None) -> Iterator[Tuple[bytes, int]]:
+    # yields (ndjson body, number of documents), batches are cut before they exceed the current
+    # batch size of the bulk controller (BULK_MAX_BYTES unless adaptive) or BULK_MAX_DOCS
+    # with a delta manifest only new or changed documents are yielded, the rest is counted in file.n_skipped
+    builder = BulkBodyBuilder(ACTION.value, file.rtime, file.uid) # use index instead of create to update existing docs
+    n_acked = file.n_acked
+    for df in timed_iter(file, 'read', data):
+        file.metrics['rows'] += len(df)
+        with timed(file, 'normalize'):
+            rows = list(normalize_frame(df, file))
+        with timed(file, 'serialize'):
+            documents = [(_id, dumps(normalized_row)) for _id, normalized_row in rows]
+        if manifest is not None and documents:
+            with timed(file, 'delta'):
+                hashes = [hashlib.blake2b(document, digest_size=16).digest() for _, document in documents]
+                changed = stage_changed_documents(manifest, file, [_id for _id, _ in documents], hashes)
+                file.n_skipped += len(documents) - len(changed)
+                documents = [document for i, document in enumerate(documents) if i in changed]
+        if n_acked: # already acknowledged before the backfill was interrupted
+            documents, n_acked = documents[n_acked:], max(0, n_acked - len(documents))
+        file.metrics['documents'] += len(documents)
+        batches = []
+        with timed(file, 'serialize'):
+            for _id, document in documents:
+                entry = builder.encode(_id, document)
+                if builder.n_docs and (len(builder) + len(entry) > bulk_controller.batch_bytes or builder.n_docs >= BULK_MAX_DOCS):
+                    batches.append(builder.flush())
+                builder.append(entry)
+        yield from batches
+    if builder.n_docs:
+        yield builder.flush()
+
+
+def generate_header_fingerprint(header_rows: Sequence[Sequence[Any]]) -> str:
+    hash_object = hashlib.sha256()
+    for row in header_rows:
+        cells = ('' if value is None or pd.isna(value) else str(value) for value in row)
+        hash_object.update('\x1f'.join(cells).encode('utf-8'))
+        hash_object.update(b'\x1e')
+    return hash_object.hexdigest()
@@ -1,61 +1,90 @@
 import hashlib
 import logging
 from datetime import datetime as dt
-from typing import Dict, Iterator, List, Optional, Union, Any
+from typing import Dict, List, Optional, Union
 
-import pandas as pd
-
-from app import ACTION, TIMESTAMP
-from app.model import (NULL_VALUES, BulkResult, BulkResultPartial, EBulkResult,
-                       EDocResult, File)
+import app
+from app import ACTION, DELTA_ENABLED
+from app.model import DOC_RESULTS, BulkResult, DocOutcomes, EBulkResult, EDocResult, File
 
 logger = logging.getLogger(__name__)
 
+INSERTED, UPDATED, CONFLICT, ERROR = (DOC_RESULTS.index(result) for result in (
+    EDocResult.DOC_INSERTED, EDocResult.DOC_UPDATED, EDocResult.DOC_CONFLICT, EDocResult.DOC_ERROR))
+
 
 def parse_bulk_result(data: Dict, file: File, n_items: int) -> BulkResult:
-    if 'errors' in data and data['errors'] and 'items' in data and len(data['items']):
-        error_counter = 0
-        for item in data['items']:
-            if 'index' in item and item['index'] and 'error' in item['index']: 
-                error_counter += 1
-                logger.error(item)
-            if error_counter >= 5: break
-    
-    if data and (('errors' in data and not data['errors']) and 'items' in data and len(data['items']) == n_items):
+    items = data.get('items', None) if data else None
+    if not (items and isinstance(items, list)):
+        result = EBulkResult.ERROR
+    elif not data.get('errors', True) and len(items) == n_items:
         result = EBulkResult.INDEXED #EBulkResult.INDEXED_UPDATE if ACTION == BULK_ACTION.INDEX else EBulkResult.INDEXED
     else:
-        result = EBulkResult.ERROR if not ('items' in data and data['items'] and isinstance(data['items'], list))\
-            else EBulkResult.UNKNOWN
-    bulk_hash = generate_timestamp_hash(TIMESTAMP)
-    return BulkResult(TIMESTAMP, bulk_hash, file, result, n_items, items=evaluate_every_bulk_result(data['items']))
+        result = EBulkResult.UNKNOWN
+    bulk_hash = generate_timestamp_hash(app.TIMESTAMP)
+    return BulkResult(app.TIMESTAMP, bulk_hash, file, result, n_items, outcomes=evaluate_bulk_items(items or []))
 
 
-def evaluate_every_bulk_result(items: List[Dict]) -> Iterator[BulkResultPartial]:
-    for item in items:
-        obj = item.get(ACTION.value, {})
-        _id = obj.get('_id', None)
-        yield \
-            BulkResultPartial(EDocResult.DOC_INSERTED, _id) \
-                if obj.get('status', None) == 201\
-            else BulkResultPartial(EDocResult.DOC_UPDATED, _id) \
-                if obj.get('status', None) == 200 and obj.get('result', None) == 'updated'\
-            else BulkResultPartial(EDocResult.DOC_CONFLICT, _id) \
-                if obj.get('status', None) == 409 or (obj.get('status', None) == 200 and obj.get('result', None) == 'noop')\
-            else BulkResultPartial(EDocResult.DOC_ERROR, _id)
-            
+def merge_bulk_results(bulk_results: List[BulkResult], file: File) -> BulkResult:
+    statuses = set(bulk_result.status for bulk_result in bulk_results)
+    if not statuses or statuses == {EBulkResult.INDEXED}:
+        result = EBulkResult.INDEXED
+    elif EBulkResult.SPOOLED in statuses and statuses <= {EBulkResult.INDEXED, EBulkResult.SPOOLED}:
+        result = EBulkResult.SPOOLED
+    elif statuses == {EBulkResult.ERROR}:
+        result = EBulkResult.ERROR
+    else:
+        result = EBulkResult.UNKNOWN
+    n_items = sum(bulk_result.n_items for bulk_result in bulk_results)
+    outcomes = DocOutcomes()
+    for bulk_result in bulk_results:
+        if bulk_result.outcomes is not None:
+            outcomes.extend(bulk_result.outcomes)
+    bulk_hash = generate_timestamp_hash(app.TIMESTAMP)
+    merged_result = BulkResult(app.TIMESTAMP, bulk_hash, file, result, n_items, outcomes=outcomes)
+    merged_result.n_skipped = file.n_skipped if DELTA_ENABLED else None
+    merged_result.n_retries = sum(bulk_result.n_retries for bulk_result in bulk_results)
+    return merged_result
+
 
-def normalize_row(row: Dict, file: File):
-    normalized_row = {}
-    for key, value in row.items():
-        if value in NULL_VALUES or pd.isnull(value) or pd.isna(value):
-            value = None
-        elif isinstance(value, pd.Timestamp) or isinstance(value, dt): 
-            value = value.isoformat()
-        elif file.normalizer:
-            value = file.normalizer(key, value)  
-        normalized_row[' '.join(key.strip().split())] = value
-    normalized_row['@uid'] = file.uid
-    return normalized_row
+def spooled_bulk_result(file: File, n_items: int) -> BulkResult:
+    bulk_hash = generate_timestamp_hash(app.TIMESTAMP)
+    return BulkResult(app.TIMESTAMP, bulk_hash, file, EBulkResult.SPOOLED, n_items)
+
+
+def failed_bulk_result(file: File, n_items: int) -> BulkResult:
+    bulk_hash = generate_timestamp_hash(app.TIMESTAMP)
+    return BulkResult(app.TIMESTAMP, bulk_hash, file, EBulkResult.ERROR, n_items)
+
+
+def evaluate_bulk_items(items: List[Dict]) -> DocOutcomes:
+    # single pass over the response items, nothing is allocated per indexed document
+    outcomes = DocOutcomes()
+    codes, counts, failed = outcomes.codes, outcomes.counts, outcomes.failed
+    action = ACTION.value
+    n_logged = 0
+    for item in items:
+        obj = item.get(action, None) if isinstance(item, dict) else None
+        if obj is None:
+            obj = {}
+        status = obj.get('status', None)
+        if status == 201:
+            code = INSERTED
+        elif status == 200:
+            result = obj.get('result', None)
+            code = UPDATED if result == 'updated' else CONFLICT if result == 'noop' else ERROR
+        elif status == 409:
+            code = CONFLICT
+        else:
+            code = ERROR
+        codes.append(code)
+        counts[code] += 1
+        if code == CONFLICT or code == ERROR:
+            failed.append((obj.get('_id', None), DOC_RESULTS[code]))
+            if 'error' in obj and n_logged < 5:
+                logger.error(item)
+                n_logged += 1
+    return outcomes
 
 
 def generate_timestamp_hash(timestamp: Optional[Union[int, float]]=None):
@@ -64,4 +93,4 @@ def generate_timestamp_hash(timestamp: Optional[Union[int, float]]=None):
     hash_object = hashlib.sha256()
     hash_object.update(timestamp_bytes)
     hash_hex = hash_object.hexdigest()[:20]
-    return hash_hex
\ No newline at end of file
+    return hash_hex
@@ -0,0 +1,55 @@
+import json
+import logging
+from typing import Any, Tuple
+
+try:
+    import orjson
+except ImportError: # optional, stdlib json is used instead
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+
+def dumps(obj: Any) -> bytes:
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+        except orjson.JSONEncodeError:
+            pass # e.g. integers over 64 bits, stdlib handles them
+    return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+
+def loads(data: Any) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class BulkBodyBuilder():
+    # action line and @uid field are encoded once per file, only the _id and the document are spliced in
+    def __init__(self, action: str, rtime: int, uid: str) -> None:
+        self.action_prefix = b'{' + dumps(action) + b':{"_id":'
+        self.action_suffix = b'}}\n'
+        self.id_suffix = '-{}'.format(rtime)
+        self.uid_field = b'"@uid":' + dumps(uid) + b'}\n'
+        self.buffer = bytearray()
+        self.n_docs = 0
+
+    def __len__(self) -> int:
+        return len(self.buffer)
+
+    def encode(self, _id: str, document: bytes) -> bytes:
+        # document is encoded without @uid, so its bytes stay comparable between runs
+        separator = b',' if len(document) > 2 else b''
+        return b''.join((self.action_prefix, dumps(_id + self.id_suffix), self.action_suffix
+                         , document[:-1], separator, self.uid_field))
+
+    def append(self, entry: bytes) -> None:
+        self.buffer += entry
+        self.n_docs += 1
+
+    def flush(self) -> Tuple[bytes, int]:
+        body, n_docs = bytes(self.buffer), self.n_docs
+        self.buffer.clear()
+        self.n_docs = 0
+        return body, n_docs
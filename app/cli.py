@@ -0,0 +1,65 @@
+import argparse
+import sys
+from datetime import datetime as dt
+from typing import List, Optional
+
+
+# entry point of main.py, services are imported per command so settings, pandas and aiohttp
+# are loaded only by the commands which need them
+def main(argv: Optional[List[str]]=None) -> int:
+    parser = argparse.ArgumentParser(description='Indexes SAP/VAS exports into elasticsearch')
+    parser.add_argument('--config-dir', default=None, help='directory with .env and config yaml files (default: config)')
+    commands = parser.add_subparsers(dest='command')
+    cache_parser = commands.add_parser('cache', help='inspect or clear the parsed workbook cache')
+    cache_parser.add_argument('action', choices=['list', 'clear'])
+    commands.add_parser('watch', help='keep running and index new exports as they land in the work dir')
+    spool_parser = commands.add_parser('spool', help='list spooled files or send them to elasticsearch')
+    spool_parser.add_argument('action', choices=['list', 'replay'])
+    commands.add_parser('backfill', help='index a large backlog with refresh and replicas turned off, resumable')
+    args = parser.parse_args(argv)
+
+    if args.config_dir:
+        from app import load_settings
+        load_settings(args.config_dir)
+
+    if args.command == 'cache':
+        from app.services.cache import clear_cached_workbooks, list_cached_workbooks
+        if args.action == 'list':
+            for meta in list_cached_workbooks():
+                print(f'{meta["key"]}  {meta["size"]:>12}  {meta["format"]:<6}  {meta["source"]:<12}  '
+                      f'{dt.fromtimestamp(meta["last_access"]).isoformat(timespec="seconds")}  {meta["path"]}')
+        else:
+            print(f'Removed {clear_cached_workbooks()} cached workbooks')
+        return 0
+
+    if args.command == 'spool' and args.action == 'list':
+        from app.services.spool import list_spooled_files
+        for meta in list_spooled_files():
+            print(f'{meta["key"]}  {sum(n for _, _, n in meta["batches"]):>9}  {len(meta["batches"]):>6}  '
+                  f'{meta["source"]:<12}  {dt.fromtimestamp(meta["rtime"]).isoformat(timespec="seconds")}  {meta["path"]}')
+        return 0
+
+    from app.services.es import bulk_files_to_es, close_es_connections, replay_spooled_files
+    if args.command != 'backfill': # a backfill restores leftovers itself, after resuming them
+        from app.services.backfill import restore_interrupted_backfill
+        restore_interrupted_backfill() # errors are logged, the run goes on, e.g. to spool
+    if args.command == 'watch':
+        from app.services.watcher import watch_work_dir
+        try:
+            watch_work_dir()
+        finally:
+            close_es_connections()
+        return 0
+    try:
+        if args.command == 'backfill':
+            from app.services.backfill import backfill_files_to_es
+            status = backfill_files_to_es()
+        else:
+            status = replay_spooled_files() if args.command == 'spool' else bulk_files_to_es()
+    finally:
+        close_es_connections()
+    return 0 if status is not False else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
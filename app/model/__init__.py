@@ -1,40 +1,73 @@
-from asyncio import AbstractEventLoop, ProactorEventLoop
+import os
+from array import array
 from enum import Enum
-from ssl import SSLContext
-from typing import Dict, Iterator, Optional, Union, Callable, Any
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple, Union, Callable
+
+if TYPE_CHECKING: # heavy imports, the model is needed before any file is read or request sent
+    from asyncio import AbstractEventLoop
+    from ssl import SSLContext
+    import pandas as pd
+    from aiohttp import ClientSession
+
 from .utils import sap_analyzer_validator, vas_normalizer
-EventLoop = Union[AbstractEventLoop, ProactorEventLoop]
+EventLoop = 'AbstractEventLoop' # ProactorEventLoop on windows is one too, asyncio is imported by the services
 
 
 class BULK_ACTION(Enum):
     INDEX = 'index'
     CREATE = 'create'
 
+class READER_MODE(Enum):
+    PANDAS = 'pandas' # whole workbook loaded into DataFrame
+    STREAMING = 'streaming' # openpyxl read-only, row at a time
+
+class SPOOL_MODE(Enum):
+    OFF = 'off'
+    FALLBACK = 'fallback' # batches are spooled only when no elasticsearch host is reachable
+    ALWAYS = 'always' # batches are only spooled, sent later by the spool replay command
+
 class EBulkResult(Enum):
     INDEXED = 'INDEXED'
     UNKNOWN = 'UNKNOWN'
     ERROR = 'ERROR'
+    SPOOLED = 'SPOOLED' # kept in the spool directory, not sent yet
     FATAL = 'FATAL' # error in code. should NEVER happen.
 
 
+class EFileStatus(Enum):
+    INDEXED = 'INDEXED'
+    FAILED = 'FAILED' # indexing failed, file is picked up again next run
+    REJECTED = 'REJECTED' # not a source file, skipped until it changes
+    SPOOLED = 'SPOOLED' # parsed, waiting in the spool for replay
+
+
 class EDocResult(Enum):
     DOC_INSERTED = 'DOC_INSERTED'
     DOC_UPDATED = 'DOC_UPDATED'
     DOC_CONFLICT = 'DOC_CONFLICT'
     DOC_ERROR = 'DOC_ERROR'
 
+DOC_RESULTS = tuple(EDocResult) # outcome code of a document is its position here
+
+
+QUERIES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'queries', '') # independent of cwd
+
 
 class ESData():
-    def __init__(self, url: str, headers: Dict, ssl: SSLContext) -> None:
+    def __init__(self, url: str, headers: Dict, ssl: 'SSLContext', session: 'ClientSession') -> None:
         self.url = url
         self.headers = headers
         self.ssl = ssl
-        self.queries = 'app/queries/'
+        self.session = session
+        self.queries = QUERIES_DIR
 
 
 VALIDATOR_FIELD = 'validator'
 NORMALIZER_FIELD = 'normalizer'
 NULL_VALUES = ['#'] 
+# strings read_excel and read_csv parse as NaN by default, kept here as pandas has them only in a private module
+NA_STRINGS = frozenset(['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN'
+                        , '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null'])
 
 class Source(Enum):
     SAP_ANALYZER = {
@@ -62,50 +95,80 @@ class Source(Enum):
         }
 
 
+# rename: (old, new) applied to every header column, e.g. 'Kr.text' -> 'Kr_text'
 SOURCES_EXPECTED_COLUMNS = {
-        Source.SAP_ANALYZER: {'columns': ['Maintenance Order (Desc)', 'Employee', 'Company ID-EMP'], 'header_idx': 0}
-        ,Source.VAS: {'columns': ['Popis poruchy', 'VAS číslo', 'Stroj'], 'header_idx': 0}
-        ,Source.SAP: {'columns': ['Kr.text', 'Zákazka'], 'header_idx': 0}
+        Source.SAP_ANALYZER: {'columns': ['Maintenance Order (Desc)', 'Employee', 'Company ID-EMP'], 'header_idx': 0, 'rename': ('.', '')}
+        ,Source.VAS: {'columns': ['Popis poruchy', 'VAS číslo', 'Stroj'], 'header_idx': 0, 'rename': ('.', '_')}
+        ,Source.SAP: {'columns': ['Kr.text', 'Zákazka'], 'header_idx': 0, 'rename': ('.', '_')}
 }
+HEADER_ROWS = max(item['header_idx'] for item in SOURCES_EXPECTED_COLUMNS.values()) + 1
+
+# seconds spent per file in read - parsing excel (lazy frames are timed while iterated), normalize, serialize,
+# delta - hashing and manifest lookups, network - bulk round trips and took - reported by elasticsearch
+FILE_STAGES = ('read', 'normalize', 'serialize', 'delta', 'network', 'took')
+FILE_COUNTERS = ('rows', 'documents', 'requests', 'retries', 'bytes')
+
 
 class File():
     def __init__(self, path: str, name: str, ctime: float) -> None:
         self.path = path
         self.name = name
         self.ctime = int(ctime)
+        self.size: int = None
+        self.mtime: int = None # nanoseconds
+        self.inode: int = None
         self.rtime: int = None # timestamp (seconds) of file processed
         self.uid: str = None # sha256 encoded timestamp (milis) of file processed
         self.source: Source = None
         self.id_field: Union[None, str] = None
-        self.row_validator: Union[None, Callable[[Dict], bool]] = None
-        self.normalizer: Union[None, Callable[[str, Any], Dict]] = None
+        self.row_validator: Union[None, Callable[['pd.DataFrame'], 'pd.Series']] = None # boolean mask of valid rows
+        self.normalizer: Union[None, Callable[[str, 'pd.Series'], 'pd.Series']] = None # normalizes one column
+        self.n_skipped: int = 0 # unchanged documents left out by delta indexing
+        self.n_acked: int = 0 # documents acknowledged before a backfill was interrupted, not sent again on resume
+        self.metrics: Dict[str, float] = dict.fromkeys(FILE_STAGES + FILE_COUNTERS, 0) # comes back with the file from workers
+
+
+class DocOutcomes():
+    # outcome code of every document in one byte and counters per outcome,
+    # _ids are kept only for documents which were not inserted or updated
+    def __init__(self) -> None:
+        self.codes = array('B')
+        self.counts: List[int] = [0] * len(DOC_RESULTS)
+        self.failed: List[Tuple[Union[str, None], EDocResult]] = []
+
+    def __len__(self) -> int:
+        return len(self.codes)
 
+    def count(self, result: EDocResult) -> int:
+        return self.counts[DOC_RESULTS.index(result)]
 
-class BulkResultPartial():
-    def __init__(self, result: EDocResult, _id: Union[str, None]) -> None:
-        self.result = result
-        self._id = _id
+    def extend(self, other: 'DocOutcomes') -> None:
+        self.codes.extend(other.codes)
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.failed.extend(other.failed)
 
 
 class BulkResult():
     def __init__(self, bulk_timestamp: float, bulk_hash: str, file: File
                  , result: EBulkResult, n_items: int
-                 , items: Optional[Iterator[BulkResultPartial]]=None) -> None:
+                 , outcomes: Optional[DocOutcomes]=None) -> None:
         self.bulk_timestamp = int(bulk_timestamp)
         self.bulk_hash = bulk_hash
         self.file = file
         self.status = result
         self.n_items = n_items
-        self.items = items
+        self.outcomes = outcomes
         self.n_inserted = None
         self.n_updated = None
         self.n_conflicted = None
         self.n_errors = None
+        self.n_skipped = None
+        self.n_retries = 0 # bulk requests resent because of rejected documents
+        self.metrics: Optional[Dict] = None # file stage timings, only attached when enabled
     
     def serialize(self):
-        source = self.file.source.value
-        source.pop(VALIDATOR_FIELD, None)
-        source.pop(NORMALIZER_FIELD, None)
+        # copy, popping from the enum value would drop validators for the next run of a long-lived process
+        source = {key: value for key, value in self.file.source.value.items() if key not in (VALIDATOR_FIELD, NORMALIZER_FIELD)}
         obj = {
             "bulk": self.bulk_hash
             ,"bulk-timestamp": self.bulk_timestamp
@@ -128,6 +191,10 @@ class BulkResult():
             obj["result"]["conflicts"] = self.n_conflicted
         if self.n_errors is not None:
             obj["result"]["errors"] = self.n_errors
+        if self.n_skipped is not None:
+            obj["result"]["skipped"] = self.n_skipped
+        if self.metrics is not None:
+            obj["metrics"] = self.metrics
         return obj
         
 
@@ -1,28 +1,43 @@
-from typing import Dict, Any
-from datetime import timedelta, datetime as dt
+import re
+from typing import TYPE_CHECKING, Any
 
-def sap_analyzer_validator(row: Dict):
-    try:
-        if int(row.get('Total no notifs', 0)) == 1: return True
-        else: return False
-    except:
-        return False
+if TYPE_CHECKING: # imported by the callables, app.model stays cheap to import
+    import pandas as pd
 
-def vas_normalizer(field_name: str, field_value: Any):
+# excel serial dates count days from 1899-12-30 (1900 leap year bug included)
+EXCEL_EPOCH = '1899-12-30T00:00:00'
+EXCEL_MAX_DAYS = 2958466 # 9999-12-31, last date representable as datetime
+INT_PATTERN = re.compile(r'\s*[+-]?\d+\s*')
+
+def sap_analyzer_validator(df: 'pd.DataFrame') -> 'pd.Series':
+    import numpy as np
+    import pandas as pd
+    if 'Total no notifs' not in df.columns:
+        return pd.Series(False, index=df.index)
+    notifs = df['Total no notifs']
+    # same as int(value) == 1, strings which int() would refuse are invalid
+    invalid_str = notifs.map(lambda value: isinstance(value, str) and INT_PATTERN.fullmatch(value) is None)
+    numbers = pd.to_numeric(notifs.mask(invalid_str), errors='coerce').astype(float)
+    return pd.Series(np.trunc(numbers) == 1, index=df.index)
+
+def vas_normalizer(field_name: str, field_values: 'pd.Series') -> 'pd.Series':
+    import numpy as np
     DATE_FIELDS = ['Time', 'Prebratie SAP', 'Prebratie terminál'
                    , 'Uzatvorenie SAP', 'Ukoncenie VAS', ]
     # FORCE_STRING_FIELDS = ['Year-month', 'Year-quarter', 'Year-week']
-    try:
-        # if field_name in FORCE_STRING_FIELDS:
-        #     return str(field_value)
-        if field_name in DATE_FIELDS and \
-            (isinstance(field_value, float) or isinstance(field_name, int)): 
-                days = int(field_value)
-                fraction = field_value - days
-                seconds = round(fraction * 86400)
-                dt_obj = dt(1900, 1, 1) + timedelta(days=days - 2, seconds=seconds)
-                date_str = dt_obj.isoformat()
-                return date_str
-        else: return field_value
-    except:
-        return None
\ No newline at end of file
+    if field_name not in DATE_FIELDS:
+        return field_values
+    is_float = field_values.map(lambda value: isinstance(value, float))
+    if not is_float.any():
+        return field_values
+    serials = field_values[is_float].to_numpy(dtype=float)
+    with np.errstate(invalid='ignore'): # inf serials, marked invalid below
+        days = np.trunc(serials)
+        seconds = np.round((serials - days) * 86400)
+    valid = np.isfinite(serials) & (days > -693594) & (days < EXCEL_MAX_DAYS)
+    offsets = np.where(valid, days * 86400 + seconds, 0).astype('int64').astype('timedelta64[s]')
+    dates: Any = np.datetime_as_string(np.datetime64(EXCEL_EPOCH, 's') + offsets, unit='s').astype(object)
+    dates[~valid] = None
+    normalized = field_values.astype(object)
+    normalized[is_float] = dates
+    return normalized
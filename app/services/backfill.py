@@ -0,0 +1,182 @@
+import asyncio
+import json
+import logging
+import os
+import signal
+import socket
+import sys
+from typing import Dict, List, Optional
+
+from app import BACKFILL_CHECKPOINT, BACKFILL_REFRESH_INTERVAL, BACKFILL_REPLICAS
+from app.apis.es import get_index_settings, put_index_settings, refresh_index
+from app.model import BulkResult, EBulkResult, EventLoop, File, Source
+from app.utils.decorators.services import service
+
+logger = logging.getLogger(__name__)
+
+TUNED_SETTINGS = ('index.refresh_interval', 'index.number_of_replicas')
+
+
+# progress of a backfill, written after every acknowledged batch: original settings of the tuned indices
+# (restored by the next backfill if the process was killed) and per file rtime, uid and the number of
+# documents acknowledged in order, so an interrupted file is resumed with identical documents
+class BackfillCheckpoint():
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.indices: Dict[str, Dict] = {} # concrete index -> original flat settings
+        self.files: Dict[str, Dict] = {} # path -> {size, mtime, rtime, uid, acked}
+        self.batches: Dict[str, List[List]] = {} # file uid -> [n_items, acknowledged] in send order, this run only
+        self.prefix: Dict[str, int] = {} # file uid -> batches acknowledged in order
+        self.owner: Optional[Dict] = None # host and pid of the backfill which wrote the checkpoint
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                saved = json.load(f)
+            self.indices, self.files = saved['indices'], saved['files']
+            self.owner = saved.get('owner', None)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f'Backfill checkpoint {path} can not be read, starting over: {str(e)}')
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'indices': self.indices, 'files': self.files
+                       , 'owner': {'host': socket.gethostname(), 'pid': os.getpid()}}, f, ensure_ascii=False)
+        os.replace(self.path + '.tmp', self.path)
+
+    def remove(self) -> None:
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def is_owner_running(self) -> bool:
+        # True unless the backfill which wrote the checkpoint is known to be gone, a backfill of another host is
+        # assumed to be running
+        if not self.owner:
+            return False
+        if self.owner.get('host', None) != socket.gethostname():
+            return True
+        if self.owner.get('pid', None) == os.getpid():
+            return False
+        try:
+            os.kill(self.owner['pid'], 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError: # alive, another user
+            pass
+        return True
+
+    def resume(self, files: List[File]) -> None:
+        # files unchanged since the interrupted backfill continue after their last acknowledged document,
+        # entries of files which are gone or already indexed are dropped
+        paths = {file.path for file in files}
+        for path in [path for path in self.files if path not in paths]:
+            del self.files[path]
+        for file in files:
+            entry = self.files.get(file.path, None)
+            if entry is None: continue
+            if (entry['size'], entry['mtime']) != (file.size, file.mtime):
+                del self.files[file.path]
+                continue
+            file.rtime, file.uid, file.n_acked = entry['rtime'], entry['uid'], entry['acked']
+            logger.info(f'Resuming backfill of file {file.name} after {file.n_acked} acknowledged documents')
+
+    def track_batch(self, file: File, n_items: int, task: asyncio.Task) -> None:
+        if file.path not in self.files:
+            self.files[file.path] = {'size': file.size, 'mtime': file.mtime, 'rtime': file.rtime
+                                     , 'uid': file.uid, 'acked': file.n_acked}
+            self.save()
+        batches = self.batches.setdefault(file.uid, [])
+        batch = [n_items, None]
+        batches.append(batch)
+        task.add_done_callback(lambda task: self.__batch_done(file, batch, task))
+
+    def __batch_done(self, file: File, batch: List, task: asyncio.Task) -> None:
+        batch[1] = not task.cancelled() and task.exception() is None and task.result().status == EBulkResult.INDEXED
+        batches = self.batches[file.uid]
+        position = start = self.prefix.get(file.uid, 0)
+        while position < len(batches) and batches[position][1]:
+            self.files[file.path]['acked'] += batches[position][0]
+            position += 1
+        if position > start:
+            self.prefix[file.uid] = position
+            self.save()
+
+    def finish_file(self, bulk_result: BulkResult) -> None:
+        if bulk_result.status == EBulkResult.INDEXED and bulk_result.file.path in self.files:
+            del self.files[bulk_result.file.path]
+            self.save()
+
+
+def backfill_files_to_es() -> bool:
+    # indices are tuned for bulk loading for the duration of the run and restored even if it fails or is stopped
+    from app.services.es import bulk_files_to_es
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(1)) # finally blocks run on SIGTERM too
+    checkpoint = BackfillCheckpoint(BACKFILL_CHECKPOINT)
+    status = False
+    try:
+        __tune_indices(checkpoint)
+        status = bulk_files_to_es(checkpoint=checkpoint)
+    finally:
+        restored = __restore_indices(checkpoint)
+        if restored and not checkpoint.files:
+            checkpoint.remove()
+        elif checkpoint.files:
+            logger.warning(f'Backfill not finished for {len(checkpoint.files)} files, run the backfill again to resume')
+    return status
+
+
+def restore_interrupted_backfill() -> None:
+    # a backfill killed without running its finally block (SIGKILL, OOM, reboot) leaves the indices unrefreshed
+    # and without replicas, every other run restores them, files to resume stay in the checkpoint
+    if not os.path.exists(BACKFILL_CHECKPOINT):
+        return
+    checkpoint = BackfillCheckpoint(BACKFILL_CHECKPOINT)
+    if not checkpoint.indices:
+        return
+    if checkpoint.is_owner_running():
+        logger.info(f'Backfill of {checkpoint.owner["host"]} ({checkpoint.owner["pid"]}) is running, index settings left tuned')
+        return
+    logger.warning(f'Backfill was interrupted, restoring settings of {len(checkpoint.indices)} indices')
+    if __restore_indices(checkpoint) and not checkpoint.files:
+        checkpoint.remove()
+
+
+@service
+def __tune_indices(loop: EventLoop, checkpoint: BackfillCheckpoint) -> None:
+    # originals are read only once, a checkpoint left by a killed backfill already holds them
+    for source in Source:
+        index = source.value.get('index')
+        settings = loop.run_until_complete(get_index_settings(index, TUNED_SETTINGS))
+        for name, values in settings.items():
+            if name not in checkpoint.indices:
+                checkpoint.indices[name] = {setting: values.get(setting, None) for setting in TUNED_SETTINGS}
+    checkpoint.save()
+    tuned = {'index': {'refresh_interval': BACKFILL_REFRESH_INTERVAL, 'number_of_replicas': BACKFILL_REPLICAS}}
+    for name in checkpoint.indices:
+        if loop.run_until_complete(put_index_settings(name, tuned)):
+            logger.info(f'Index {name} tuned for backfill: {tuned["index"]}')
+        else:
+            logger.error(f'Index {name} settings could not be changed for backfill')
+
+
+@service
+def __restore_indices(loop: EventLoop, checkpoint: BackfillCheckpoint) -> bool:
+    restored = True
+    for name, originals in list(checkpoint.indices.items()):
+        settings = {setting.split('.', 1)[1]: value for setting, value in originals.items()}
+        try:
+            acknowledged = loop.run_until_complete(put_index_settings(name, {'index': settings}))
+            refreshed = acknowledged and loop.run_until_complete(refresh_index(name))
+        except Exception as e:
+            logger.error(f'Index {name} settings could not be restored: {str(e)}')
+            acknowledged = refreshed = False
+        if not acknowledged:
+            restored = False
+            continue
+        logger.info(f'Index {name} settings restored: {settings}{"" if refreshed else ", refresh failed"}')
+        del checkpoint.indices[name]
+        checkpoint.save()
+    return restored
@@ -0,0 +1,152 @@
+import hashlib
+import json
+import logging
+import os
+import pickle
+from datetime import datetime as dt
+from typing import Dict, List, Tuple, Union
+
+import pandas as pd
+
+from app import CACHE_DIR, CACHE_MAX_BYTES
+from app.model import File, Source
+
+try:
+    import pyarrow as pa
+except ImportError: # optional, frames are pickled instead
+    pa = None
+
+logger = logging.getLogger(__name__)
+
+# column types arrow stores without changing the values read from excel
+ARROW_SAFE_TYPES = ('string', 'integer', 'floating', 'boolean', 'datetime', 'datetime64', 'empty')
+ARROW_FORMAT = 'arrow'
+PICKLE_FORMAT = 'pickle'
+
+
+def workbook_cache_key(file: File) -> str:
+    stat = os.stat(file.path)
+    content_hash = hashlib.sha256()
+    with open(file.path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            content_hash.update(block)
+    key = f'{os.path.abspath(file.path)}|{stat.st_size}|{stat.st_mtime_ns}|{content_hash.hexdigest()}'
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+
+
+def get_cached_workbook(key: str) -> Union[Tuple[pd.DataFrame, Source], None]:
+    meta_path = os.path.join(CACHE_DIR, f'{key}.json')
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        data_path = os.path.join(CACHE_DIR, meta['data'])
+        if meta['format'] == ARROW_FORMAT:
+            with pa.memory_map(data_path, 'r') as source:
+                table = pa.ipc.open_file(source).read_all()
+            df = table.to_pandas(integer_object_nulls=True, timestamp_as_object=True)
+            df = __restore_integers(df, meta['integer_columns'])
+        else:
+            df = pd.read_pickle(data_path)
+        df.columns = meta['columns']
+        os.utime(meta_path) # meta mtime is the last access for eviction
+    except (OSError, KeyError, ValueError, pickle.UnpicklingError):
+        return None
+    except Exception as e:
+        logger.warning(f'Cached workbook {key} can not be read: {str(e)}')
+        return None
+    logger.info(f'Parsed workbook loaded from cache: {meta["path"]}')
+    return df, Source[meta['source']]
+
+
+def cache_workbook(key: str, file: File, df: pd.DataFrame, source: Source) -> None:
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    columns = [str(col) for col in df.columns]
+    df = df.set_axis([str(i) for i in range(len(columns))], axis=1) # positional names, headers may repeat
+    meta = {'path': file.path, 'source': source.name, 'columns': columns
+            , 'created': dt.now().isoformat(), 'integer_columns': []}
+    try:
+        if pa is None:
+            raise TypeError('pyarrow not installed')
+        table, meta['integer_columns'] = __to_arrow_table(df)
+        meta['format'], meta['data'] = ARROW_FORMAT, f'{key}.arrow'
+        with pa.OSFile(os.path.join(CACHE_DIR, meta['data']), 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+    except (TypeError, ValueError, NotImplementedError): # arrow errors subclass these
+        meta['format'], meta['data'] = PICKLE_FORMAT, f'{key}.pkl'
+        df.to_pickle(os.path.join(CACHE_DIR, meta['data']))
+    with open(os.path.join(CACHE_DIR, f'{key}.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+    evict_cached_workbooks()
+
+
+def __to_arrow_table(df: pd.DataFrame) -> Tuple['pa.Table', List[str]]:
+    # excel integers inside float columns get a mask column, so they are not restored as floats,
+    # every column is checked before any is converted and the frame itself is left as read (pickled on failure)
+    inferred = {col: pd.api.types.infer_dtype(df[col], skipna=True) for col in df.columns}
+    for col, kind in inferred.items():
+        if kind not in ARROW_SAFE_TYPES and kind != 'mixed-integer-float':
+            raise TypeError(f'column {col} of type {kind} can not be stored as arrow')
+    columns = {}
+    integer_columns = []
+    for col in df.columns:
+        if inferred[col] == 'mixed-integer-float':
+            columns[col] = pd.to_numeric(df[col]).astype(float)
+            columns[f'{col}__int'] = df[col].map(lambda value: isinstance(value, int))
+            integer_columns.append(col)
+        else:
+            columns[col] = df[col]
+    return pa.Table.from_pandas(pd.DataFrame(columns), preserve_index=False), integer_columns
+
+
+def __restore_integers(df: pd.DataFrame, integer_columns: List[str]) -> pd.DataFrame:
+    for col in integer_columns:
+        is_int = df.pop(f'{col}__int').to_numpy(dtype=bool)
+        values = df[col].to_numpy(dtype=object)
+        values[is_int] = [int(value) for value in values[is_int]]
+        df[col] = values
+    return df
+
+
+def list_cached_workbooks() -> List[Dict]:
+    entries = []
+    if not os.path.isdir(CACHE_DIR):
+        return entries
+    for entry in os.scandir(CACHE_DIR):
+        if not entry.name.endswith('.json'): continue
+        try:
+            with open(entry.path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            meta['key'] = entry.name[:-len('.json')]
+            meta['size'] = os.path.getsize(os.path.join(CACHE_DIR, meta['data']))
+            meta['last_access'] = entry.stat().st_mtime
+        except (OSError, KeyError, ValueError):
+            continue
+        entries.append(meta)
+    return sorted(entries, key=lambda meta: meta['last_access'], reverse=True)
+
+
+def evict_cached_workbooks() -> None:
+    # least recently used entries are removed until the cache fits into CACHE_MAX_BYTES
+    entries = list_cached_workbooks()
+    total_size = sum(meta['size'] for meta in entries)
+    while entries and total_size > CACHE_MAX_BYTES:
+        meta = entries.pop()
+        __remove_cached_workbook(meta)
+        total_size -= meta['size']
+        logger.info(f'Evicted cached workbook: {meta["path"]}')
+
+
+def clear_cached_workbooks() -> int:
+    entries = list_cached_workbooks()
+    for meta in entries:
+        __remove_cached_workbook(meta)
+    return len(entries)
+
+
+def __remove_cached_workbook(meta: Dict) -> None:
+    for name in (meta['data'], f'{meta["key"]}.json'):
+        try:
+            os.remove(os.path.join(CACHE_DIR, name))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,148 @@
+import codecs
+import csv
+import logging
+from typing import Any, Optional
+
+import numpy as np
+import pandas as pd
+
+from app import CSV_DELIMITER, CSV_ENCODINGS
+from app.model import NA_STRINGS
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+except ImportError: # optional, csv is read by pandas instead, parquet is not supported
+    pa = None
+
+logger = logging.getLogger(__name__)
+
+# csv and parquet exports read into the same frames as excel files: object columns with values typed the way
+# read_excel types cells, so source detection, renaming and normalization produce identical documents
+CSV_EXTENSIONS = ('.csv', '.tsv', '.txt')
+PARQUET_EXTENSIONS = ('.parquet', '.pq')
+COLUMNAR_EXTENSIONS = CSV_EXTENSIONS + PARQUET_EXTENSIONS
+DELIMITERS = (';', ',', '\t', '|')
+NA_VALUES = sorted(NA_STRINGS) # cells read_excel parses as NaN, used by both csv readers and for parquet strings
+ENCODING_SAMPLE_BYTES = 1024 * 1024
+# text excel writes for numeric, date and boolean cells, numbers with leading zeros stay text like in excel
+INT_PATTERN = r'^-?(0|[1-9][0-9]*)$'
+FLOAT_PATTERN = r'^-?(0|[1-9][0-9]*)?\.[0-9]+([eE][+-]?[0-9]+)?$|^-?(0|[1-9][0-9]*)[eE][+-]?[0-9]+$'
+DATETIME_PATTERN = r'^[0-9]{4}-[0-9]{2}-[0-9]{2}([ T][0-9]{2}:[0-9]{2}(:[0-9]{2}(\.[0-9]{1,6})?)?)?$'
+BOOLEANS = {'TRUE': True, 'FALSE': False, 'True': True, 'False': False}
+
+
+def detect_encoding(path: str) -> str:
+    # byte order mark, then the first configured encoding which decodes the head of the file,
+    # cp1250 (slovak windows exports) decodes nearly anything, so it belongs at the end
+    with open(path, 'rb') as f:
+        sample = f.read(ENCODING_SAMPLE_BYTES)
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if sample.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return 'utf-16'
+    for encoding in CSV_ENCODINGS:
+        try:
+            codecs.getincrementaldecoder(encoding)().decode(sample, final=False) # sample may end mid character
+            return encoding
+        except (UnicodeDecodeError, LookupError):
+            continue
+    return CSV_ENCODINGS[-1]
+
+
+def read_csv_file(path: str) -> pd.DataFrame:
+    # every row including the header rows, columns numbered like read_excel(header=None)
+    encoding = detect_encoding(path)
+    with open(path, 'r', encoding=encoding, errors='replace', newline='') as f:
+        header = f.readline()
+    delimiter = CSV_DELIMITER or ('\t' if path.endswith('.tsv') else max(DELIMITERS, key=header.count))
+    n_columns = len(next(csv.reader([header], delimiter=delimiter), []))
+    if pa is not None:
+        try:
+            return __read_csv_with_arrow(path, encoding, delimiter, n_columns)
+        except pa.ArrowInvalid as e: # e.g. rows with more or fewer fields than the header
+            logger.warning(f'File {path} read by pandas, arrow refused it: {str(e)}')
+    df = pd.read_csv(path, header=None, dtype=object, keep_default_na=False, na_values=NA_VALUES, sep=delimiter
+                     , encoding=encoding)
+    df = df.where(df.notna(), None) # None like arrow's nulls
+    return pd.DataFrame({i: type_text_cells(df[column].to_numpy(dtype=object)) for i, column in enumerate(df.columns)}
+                        , dtype=object)
+
+
+def __read_csv_with_arrow(path: str, encoding: str, delimiter: str, n_columns: int) -> pd.DataFrame:
+    # all columns are read as text on arrow's reader threads and typed per cell afterwards,
+    # a column mixing numbers and text keeps both like in excel
+    names = [str(i) for i in range(n_columns)]
+    table = pa_csv.read_csv(path
+        , read_options=pa_csv.ReadOptions(encoding=encoding.replace('-sig', ''), column_names=names, use_threads=True)
+        , parse_options=pa_csv.ParseOptions(delimiter=delimiter, newlines_in_values=True)
+        , convert_options=pa_csv.ConvertOptions(column_types={name: pa.string() for name in names}, null_values=NA_VALUES
+                                                , strings_can_be_null=True, quoted_strings_can_be_null=True))
+    return pd.DataFrame({i: type_text_cells(column.to_numpy(zero_copy_only=False), column)
+                         for i, column in enumerate(table.columns)}, dtype=object)
+
+
+def read_parquet_file(path: str) -> pd.DataFrame:
+    # memory-mapped, column names are the header row, typed columns only need excel's int/float distinction
+    if pa is None:
+        raise ImportError('pyarrow is required to read parquet exports')
+    table = pq.read_table(path, memory_map=True, use_threads=True)
+    columns = {}
+    for name, column in zip(table.column_names, table.columns):
+        if pa.types.is_date(column.type): # excel has no dates without time
+            column = pc.cast(column, pa.timestamp('ms'))
+        elif pa.types.is_decimal(column.type):
+            column = pc.cast(column, pa.float64())
+        values = column.to_numpy(zero_copy_only=False)
+        if pa.types.is_timestamp(column.type):
+            values = np.array(column.to_pylist(), dtype=object)
+        elif pa.types.is_floating(column.type):
+            values = __integral_floats(values)
+        elif pa.types.is_string(column.type) or pa.types.is_large_string(column.type):
+            values = values.astype(object)
+            values[pc.is_in(column, value_set=pa.array(NA_VALUES)).to_numpy(zero_copy_only=False)] = None
+        else:
+            values = values.astype(object)
+            if pa.types.is_integer(column.type) and column.null_count:
+                values = np.array(column.to_pylist(), dtype=object) # ints with nulls came back as floats
+        columns[name] = values
+    return pd.DataFrame(columns, columns=table.column_names, dtype=object)
+
+
+def type_text_cells(values: np.ndarray, column: Optional[Any]=None) -> np.ndarray:
+    # str/None cells to the types openpyxl and read_excel give excel cells, matched by arrow's
+    # multithreaded regex kernels when the column comes from arrow, by pandas otherwise
+    typed = values.astype(object, copy=True)
+    ints = __matches(values, column, INT_PATTERN)
+    if ints.any():
+        typed[ints] = [int(value) for value in values[ints]]
+    floats = __matches(values, column, FLOAT_PATTERN)
+    if floats.any():
+        typed[floats] = __integral_floats(values[floats].astype(float))
+    dates = __matches(values, column, DATETIME_PATTERN)
+    if dates.any():
+        stamps = pd.to_datetime(pd.Series(values[dates]), format='ISO8601', errors='coerce')
+        valid = stamps.notna().to_numpy()
+        converted = values[dates].astype(object)
+        converted[valid] = stamps[valid].dt.to_pydatetime()
+        typed[dates] = converted
+    for text, value in BOOLEANS.items():
+        typed[values == text] = value
+    return typed
+
+
+def __matches(values: np.ndarray, column: Optional[Any], pattern: str) -> np.ndarray:
+    if column is not None:
+        return pc.match_substring_regex(column, pattern).fill_null(False).to_numpy(zero_copy_only=False)
+    return pd.Series(values, dtype=object).str.match(pattern, na=False).to_numpy(dtype=bool)
+
+
+def __integral_floats(values: np.ndarray) -> np.ndarray:
+    # same as the streaming reader's cell conversion, 2.0 is 2 like in read_excel
+    typed = values.astype(object)
+    integral = np.isfinite(values) & (np.trunc(values) == values)
+    typed[integral] = [int(value) for value in values[integral]]
+    typed[np.isnan(values)] = None
+    return typed
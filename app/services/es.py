@@ -1,92 +1,303 @@
 import asyncio
-import json
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from datetime import datetime as dt
-from typing import Coroutine, List, Union
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
 
-import pandas as pd
-
-from app import ACTION, BULK_ACTION
-from app.apis.es import (bulk, get_last_indexed_timestamp,
-                         post_bulk_result)
-from app.apis.utils.helpers import normalize_row
-from app.model import BulkResult, EBulkResult, EDocResult, EventLoop
+from app import (ACTION, BULK_ACTION, DELTA_ENABLED, METRICS_ATTACH, METRICS_ENABLED,
+                 METRICS_FORMAT, METRICS_PATH, PROFILING_ENABLED, PROFILING_PATH, READER_READ_AHEAD, SPOOL)
+from app.apis.es import bulk, get_last_indexed_timestamp, post_bulk_results
+from app.apis.controller import bulk_controller
+from app.apis.pool import es_pool
+from app.apis.utils.helpers import failed_bulk_result, merge_bulk_results, spooled_bulk_result
+from app.model import SPOOL_MODE, BulkResult, EBulkResult, EDocResult, EFileStatus, EventLoop, File
+from app.services.leases import lease_keeper, release_files
+from app.services.ledger import record_files
+from app.services.manifest import commit_staged_documents, discard_staged_documents
+from app.services.spool import (SpoolSegment, close_spool_segment, list_spooled_files, open_spool_segment,
+                                read_spooled_batches, remove_spooled_file, spooled_file)
+from app.utils.decorators.es import ESUnavailableError
 from app.utils.decorators.services import service
+from app.utils.metrics import run_metrics
+from app.utils.profiling import profiled, stage_profiler
+
+if TYPE_CHECKING:
+    from app.services.backfill import BackfillCheckpoint
 
 logger = logging.getLogger(__name__)
 
-def obtain_last_indexed_timestamp() -> Union[float, None]:
-    return __obtain_last_indexed_timestamp()
 
-def bulk_files_to_es() -> bool:
-    results: List[BulkResult] = __bulk_files_to_es()
-    status = __check_results_and_post_last_timestamp(results)
+class PipelineStoppedError(Exception):
+    pass
+
+def obtain_last_indexed_timestamp(required: bool=True) -> Union[float, None]:
+    return __obtain_last_indexed_timestamp(required)
+
+def close_es_connections() -> None:
+    __close_es_connections()
+
+def bulk_files_to_es(files: Optional[List[File]]=None, checkpoint: Optional['BackfillCheckpoint']=None) -> bool:
+    run_metrics.reset()
+    __start_profiling()
+    try:
+        results: List[BulkResult] = __bulk_files_to_es(files, checkpoint)
+        status = __check_results_and_post_last_timestamp(results)
+    finally:
+        lease_keeper.release_all() # leases of files the run did not get to finish
+        __write_profiles()
+    __write_run_metrics()
+    return status
+
+def replay_spooled_files() -> bool:
+    run_metrics.reset()
+    __start_profiling()
+    try:
+        results: List[BulkResult] = __replay_spooled_files()
+        status = __check_results_and_post_last_timestamp(results)
+    finally:
+        __write_profiles()
+    __write_run_metrics()
     return status
 
 
+def __write_run_metrics() -> None:
+    if METRICS_ENABLED:
+        try:
+            run_metrics.write_report(METRICS_PATH, METRICS_FORMAT)
+        except OSError as e:
+            logger.error(f'Run metrics can not be written: {str(e)}')
+
+
+def __start_profiling() -> None:
+    if PROFILING_ENABLED:
+        stage_profiler.start()
+
+
+def __write_profiles() -> None:
+    # written even if the run failed, a crashing export is what profiling is most often needed for
+    if not stage_profiler.enabled:
+        return
+    stage_profiler.stop()
+    try:
+        logger.info(f'Profiles written to {stage_profiler.dump(PROFILING_PATH)}')
+    except OSError as e:
+        logger.error(f'Profiles can not be written: {str(e)}')
+
+
 @service
-def __obtain_last_indexed_timestamp(loop: EventLoop) -> Union[float, None]:
-    last_timestamp = loop.run_until_complete(get_last_indexed_timestamp())
+def __obtain_last_indexed_timestamp(loop: EventLoop, required: bool) -> Union[float, None]:
+    try:
+        last_timestamp = loop.run_until_complete(get_last_indexed_timestamp())
+    except Exception as e: # e.g. unreachable while bootstrapping the ledger, the scan goes on without it
+        if required:
+            raise e
+        logger.warning(f'Last indexed time not available: {type(e).__name__} {str(e)}')
+        return None
     return last_timestamp
 
 
+@service
+def __close_es_connections(loop: EventLoop) -> None:
+    loop.run_until_complete(es_pool.close())
+
+
 @service
 def __save_bulk_results(loop: EventLoop, bulk_results: List[BulkResult]) -> bool:
-    tasks = asyncio.gather(*(post_bulk_result(bulk_result) for bulk_result in bulk_results))
-    statuses = loop.run_until_complete(tasks)
-    return all(statuses)
+    if not bulk_results:
+        return True
+    return loop.run_until_complete(post_bulk_results(bulk_results))
+
+
+@service
+def __bulk_files_to_es(loop: EventLoop, files: Optional[List[File]]=None
+                       , checkpoint: Optional['BackfillCheckpoint']=None) -> List[BulkResult]:
+    if files is None:
+        with profiled('scan'):
+            files = scan_for_new_files() # must run before the pipeline, it uses the event loop on its own
+    if checkpoint is not None:
+        checkpoint.resume(files)
+    if not files:
+        return []
+    from app.services.reader import read_batches # pandas and openpyxl are imported only when there is something to read
+    # not profiled as a whole, python 3.12+ allows one active profiler per process and the reader thread's
+    # stages need it, the loop side profiles its synchronous parts (encode, parse) on its own
+    results: List[BulkResult] = loop.run_until_complete(__bulk_files_pipeline(read_batches(files), SPOOL, checkpoint))
+    return results
 
 
 @service
-def __bulk_files_to_es(loop: EventLoop) -> List[BulkResult]:
-    coroutines: List[Coroutine] = []
-    for data, file in read_files():
-        logger.info('Bulking data for file:')
-        logger.info(file.path)
-        logger.info(dt.fromtimestamp(file.ctime).isoformat())
-        rows = []
-        for i, row in enumerate(data, start=1):
-            _id = row.get(file.id_field, None)
-            if not _id or pd.isna(_id): continue
-            id_with_timestamp = '{}-{}'.format(_id, file.rtime)
-            if file.row_validator is not None and not file.row_validator(row): continue
-            rows.append(json.dumps({ACTION.value: {'_id': id_with_timestamp}})) # use index instead of create to update existing docs
-            normalized_row = normalize_row(row, file)
-            rows.append(json.dumps(normalized_row, ensure_ascii=False))
-        bulk_data = '\n'.join(rows) + '\n'
-        coroutines.append(bulk(bulk_data, file, i))
+def __replay_spooled_files(loop: EventLoop) -> List[BulkResult]:
+    # spooled batches are sent as they were built, without reading the excel files again
+    spooled = list_spooled_files()
+    logger.info(f'Number of spooled files to replay: {len(spooled)}')
+    if not spooled:
+        return []
+    file_batches = ((read_spooled_batches(meta), spooled_file(meta)) for meta in spooled)
+    results: List[BulkResult] = loop.run_until_complete(__bulk_files_pipeline(file_batches, SPOOL_MODE.OFF))
+    for meta, bulk_result in zip(spooled, results):
+        if bulk_result.status == EBulkResult.INDEXED:
+            remove_spooled_file(meta['key'])
+        else: # kept for the next replay, not picked up by a regular run
+            record_files([bulk_result.file], EFileStatus.SPOOLED)
+    return results
+
+
+async def __bulk_files_pipeline(file_batches: Iterable[Tuple[Iterator[Tuple[bytes, int]], File]]
+                                , spool: SPOOL_MODE, checkpoint: Optional['BackfillCheckpoint']=None) -> List[BulkResult]:
+    # files are read and serialized on a reader thread, batches are sent while later files are still being read,
+    # with at most as many requests in flight as the bulk controller allows
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=READER_READ_AHEAD)
+    stopped = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='reader')
+    producer = loop.run_in_executor(executor, __read_ahead, file_batches, queue, loop, stopped)
+    producer.add_done_callback(lambda f: f.cancelled() or f.exception()) # retrieved even if the pipeline fails first
+    pending: Set[asyncio.Task] = set()
+    file_tasks: List[Tuple[File, List[asyncio.Task], bool]] = []
+    segments: Dict[str, SpoolSegment] = {} # file uid -> segment of spooled batches
+    try:
+        while True:
+            message = await queue.get()
+            if message is None: break
+            kind, file, *payload = message
+            if kind == 'file':
+                logger.info('Bulking data for file:')
+                logger.info(file.path)
+                logger.info(dt.fromtimestamp(file.ctime).isoformat())
+                file_tasks.append((file, [], False))
+            elif kind == 'batch':
+                bulk_data, n_items = payload
+                pending = __raise_failed_batch(pending)
+                while len(pending) >= bulk_controller.max_in_flight: # backpressure, the reader waits once the queue is full
+                    await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    pending = __raise_failed_batch(pending)
+                task = asyncio.ensure_future(__bulk_or_spool(bulk_data, file, n_items, spool, segments))
+                pending.add(task)
+                file_tasks[-1][1].append(task)
+                if checkpoint is not None:
+                    checkpoint.track_batch(file, n_items, task)
+            else: # read error, batches sent so far are kept, the file fails as a whole
+                logger.error(f'File {file.name} can not be read')
+                logger.error(str(payload[0]))
+                file_tasks[-1] = (file, file_tasks[-1][1], True)
+        await producer # errors outside of single files, e.g. of the process pool
+        batch_results = [await asyncio.gather(*tasks) for _, tasks, _ in file_tasks]
+    except BaseException as e: # e.g. elasticsearch unavailable with the spool off
+        stopped.set() # the reader stops before parsing the next file
+        await __cancel_batches(file_tasks)
+        raise e
+    finally:
+        stopped.set()
+        executor.shutdown(wait=False)
     
-    tasks = asyncio.gather(*coroutines)
-    results: List[BulkResult] = loop.run_until_complete(tasks)
+    results: List[BulkResult] = []
+    for (file, _, read_error), file_results in zip(file_tasks, batch_results):
+        bulk_result = merge_bulk_results(file_results, file)
+        if read_error:
+            bulk_result.status = EBulkResult.ERROR
+        close_spool_segment(file, segments, keep=bulk_result.status == EBulkResult.SPOOLED)
+        if DELTA_ENABLED: # hashes are kept only for fully indexed files, the rest is sent again next run
+            if bulk_result.status == EBulkResult.INDEXED:
+                commit_staged_documents(file)
+            elif bulk_result.status != EBulkResult.SPOOLED: # spooled hashes are committed after replay
+                discard_staged_documents([file])
+        if checkpoint is not None:
+            checkpoint.finish_file(bulk_result)
+        file_metrics = run_metrics.observe_file(bulk_result)
+        if METRICS_ATTACH:
+            bulk_result.metrics = file_metrics
+        results.append(bulk_result)
+    record_files([r.file for r in results if r.status == EBulkResult.INDEXED], EFileStatus.INDEXED)
+    record_files([r.file for r in results if r.status == EBulkResult.SPOOLED], EFileStatus.SPOOLED)
+    record_files([r.file for r in results if r.status not in (EBulkResult.INDEXED, EBulkResult.SPOOLED)], EFileStatus.FAILED)
+    release_files([r.file for r in results if r.status == EBulkResult.INDEXED], EFileStatus.INDEXED) # no-op outside of cluster mode
+    release_files([r.file for r in results if r.status == EBulkResult.SPOOLED], EFileStatus.SPOOLED)
+    release_files([r.file for r in results if r.status not in (EBulkResult.INDEXED, EBulkResult.SPOOLED)])
     return results 
 
 
+def __raise_failed_batch(pending: Set[asyncio.Task]) -> Set[asyncio.Task]:
+    # batches only raise what fails the whole run (elasticsearch unavailable with the spool off),
+    # raised as soon as it is done instead of after every remaining file was read and sent
+    for task in pending:
+        if task.done() and not task.cancelled() and task.exception() is not None:
+            raise task.exception()
+    return {task for task in pending if not task.done()}
+
+
+async def __cancel_batches(file_tasks: List[Tuple[File, List[asyncio.Task], bool]]) -> None:
+    # requests still in flight when the pipeline fails are dropped, none is left un-awaited
+    tasks = [task for _, file_batch_tasks, _ in file_tasks for task in file_batch_tasks]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def __read_ahead(file_batches: Iterable[Tuple[Iterator[Tuple[bytes, int]], File]], queue: asyncio.Queue
+                 , loop: asyncio.AbstractEventLoop, stopped: threading.Event) -> None:
+    # runs on the reader thread, blocks while the queue is full, so at most READER_READ_AHEAD batches wait in memory
+    def put(message: Optional[Tuple]) -> None:
+        future = asyncio.run_coroutine_threadsafe(queue.put(message), loop)
+        while True:
+            try:
+                return future.result(timeout=0.5)
+            except FutureTimeoutError:
+                if stopped.is_set(): # the pipeline failed, nobody reads the queue anymore
+                    future.cancel()
+                    raise PipelineStoppedError('Bulk pipeline stopped, files are not read anymore')
+    try:
+        for batches, file in file_batches:
+            put(('file', file))
+            try:
+                for bulk_data, n_items in batches:
+                    put(('batch', file, bulk_data, n_items))
+            except PipelineStoppedError as e:
+                raise e
+            except Exception as e:
+                put(('error', file, e))
+    finally:
+        close = getattr(file_batches, 'close', None)
+        if close is not None: # stops the process pool of the workers reader
+            close()
+        if not stopped.is_set():
+            put(None)
+
+
+async def __bulk_or_spool(bulk_data: bytes, file: File, n_items: int
+                          , spool: SPOOL_MODE, segments: Dict[str, SpoolSegment]) -> BulkResult:
+    if spool != SPOOL_MODE.ALWAYS:
+        try:
+            return await bulk(bulk_data, file, n_items)
+        except ESUnavailableError as e:
+            if spool == SPOOL_MODE.OFF:
+                raise e
+            logger.error(f'{str(e)}, batch of file {file.name} spooled')
+        except Exception as e: # e.g. timeout or dropped connection, only this file fails
+            logger.error(f'Batch of file {file.name} failed: {type(e).__name__} {str(e)}')
+            return failed_bulk_result(file, n_items)
+    open_spool_segment(file, segments).append(bulk_data, n_items)
+    return spooled_bulk_result(file, n_items)
+
+
 def __check_results_and_post_last_timestamp(bulk_results: List[BulkResult]) -> bool:
     # results MUST be sorted by file creation times - ctimes "asc" oldest should be last
     for bulk_result in bulk_results:
         logger.info(f'File: {bulk_result.file.name}, result: {bulk_result.status.value}')
-        if bulk_result.status in [EBulkResult.INDEXED, EBulkResult.UNKNOWN] and bulk_result.items:
-            insert_counter = 0
-            update_counter = 0
-            error_counter = 0
-            conflict_counter = 0
-            for partial_result in bulk_result.items:
-                if partial_result.result == EDocResult.DOC_INSERTED:
-                    insert_counter += 1
-                if partial_result.result == EDocResult.DOC_UPDATED:
-                    update_counter += 1
-                    # logger.warning(f'Indexing update on _id: {partial_result._id}')
-                if partial_result.result == EDocResult.DOC_CONFLICT:
-                    conflict_counter += 1
-                    # logger.warning(f'Indexing integrity_conflict on _id: {partial_result._id}')
-                elif partial_result.result == EDocResult.DOC_ERROR: # no other option else could be used
-                    error_counter += 1
-                    # logger.error(f'Indexing error on _id: {partial_result._id}')
-            bulk_result.n_inserted = insert_counter
-            bulk_result.n_updated = update_counter
-            bulk_result.n_errors = error_counter
+        if bulk_result.status in [EBulkResult.INDEXED, EBulkResult.UNKNOWN] and bulk_result.outcomes is not None:
+            outcomes = bulk_result.outcomes # counted while the responses were decoded
+            bulk_result.n_inserted = outcomes.count(EDocResult.DOC_INSERTED)
+            bulk_result.n_updated = outcomes.count(EDocResult.DOC_UPDATED)
+            bulk_result.n_errors = outcomes.count(EDocResult.DOC_ERROR)
             if ACTION == BULK_ACTION.CREATE:
-                bulk_result.n_conflicted = conflict_counter
+                bulk_result.n_conflicted = outcomes.count(EDocResult.DOC_CONFLICT)
+            if outcomes.failed:
+                logger.warning(f'File {bulk_result.file.name}: {len(outcomes.failed)} documents not indexed, first _ids: '
+                               f'{", ".join(f"{_id} ({result.value})" for _id, result in outcomes.failed[:10])}')
+        
+        elif bulk_result.status == EBulkResult.SPOOLED:
+            logger.warning(f'File {bulk_result.file.name} spooled, indexed by the spool replay')
         
         elif bulk_result.status == EBulkResult.ERROR:
             #? send info mail
@@ -105,7 +316,8 @@ def __check_results_and_post_last_timestamp(bulk_results: List[BulkResult]) -> b
     logger.info('Bulk data prepared to be indexed...')
     for bulk_result in bulk_results:
         logger.info(bulk_result.serialize())
-    status = __save_bulk_results(bulk_results)
+    logger.info(f'Bulk controller: {bulk_controller.summary()}')
+    status = __save_bulk_results([r for r in bulk_results if r.status != EBulkResult.SPOOLED]) # posted after replay
     if status:
         logger.info('Bulk data indexed to elasticsearch')
     else:
@@ -114,4 +326,4 @@ def __check_results_and_post_last_timestamp(bulk_results: List[BulkResult]) -> b
     return status
 
 
-from app.services.reader import read_files
+from app.services.scanner import scan_for_new_files
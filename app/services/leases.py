@@ -0,0 +1,174 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+from app import CLUSTER_DIR, CLUSTER_INSTANCE, CLUSTER_LEASE_TTL, WORK_DIR
+from app.model import EFileStatus, File
+
+logger = logging.getLogger(__name__)
+
+LEASES_DIR = os.path.join(CLUSTER_DIR, 'leases') # <key>.lock, held while an instance works on the file
+DONE_DIR = os.path.join(CLUSTER_DIR, 'done') # <key>.json, file version finished by any instance
+RTIMES_DIR = os.path.join(CLUSTER_DIR, 'rtimes') # one empty file per rtime taken by any instance
+RTIME_RETENTION = 86400 # seconds, older reservations can not collide with new ones anymore
+
+
+# leases are lock files created with O_EXCL, which is atomic on local file systems and on NFSv3+,
+# a lease is kept alive by touching its lock file and is taken over once not touched for CLUSTER_LEASE_TTL
+class LeaseKeeper():
+    def __init__(self) -> None:
+        self.held: Dict[str, str] = {} # file path -> lock path
+        self.lock = threading.Lock()
+        self.renewer: Optional[threading.Thread] = None
+        self.stopped = threading.Event()
+        self.pruned = False
+
+    def claim(self, file: File) -> bool:
+        # False if another live instance works on the file or already finished this version of it
+        os.makedirs(LEASES_DIR, exist_ok=True)
+        lock_path = os.path.join(LEASES_DIR, file_key(file) + '.lock')
+        if not (self.__create(lock_path) or (self.__take_over_stale(lock_path) and self.__create(lock_path))):
+            return False
+        if get_done_status(file) is not None: # finished by another instance between the scan and now
+            self.__remove(lock_path)
+            return False
+        with self.lock:
+            self.held[file.path] = lock_path
+            if self.renewer is None or self.stopped.is_set(): # a new event, the old renewer may still be winding down
+                self.stopped = threading.Event()
+                self.renewer = threading.Thread(target=self.__renew, args=(self.stopped,), name='lease-renewer', daemon=True)
+                self.renewer.start()
+        return True
+
+    def release(self, file: File, status: Optional[EFileStatus]=None) -> None:
+        # with a status the file version is marked as done for all instances, failed files are only released
+        with self.lock:
+            lock_path = self.held.pop(file.path, None)
+        if lock_path is None:
+            return
+        if status is not None:
+            mark_done(file, status)
+        self.__remove(lock_path)
+
+    def release_all(self) -> None:
+        with self.lock:
+            held, self.held = self.held, {}
+            self.stopped.set()
+        for lock_path in held.values():
+            self.__remove(lock_path)
+
+    def reserve_rtime(self, start: int) -> int:
+        # first free second from start on, unique across instances, so rtime, uid and _id suffixes never collide
+        os.makedirs(RTIMES_DIR, exist_ok=True)
+        if not self.pruned:
+            self.__prune_rtimes(start - RTIME_RETENTION)
+        rtime = start
+        while True:
+            try:
+                os.close(os.open(os.path.join(RTIMES_DIR, str(rtime)), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return rtime
+            except FileExistsError:
+                rtime += 1
+
+    def __create(self, lock_path: str) -> bool:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({'instance': CLUSTER_INSTANCE, 'claimed': time.time()}, f)
+        return True
+
+    def __take_over_stale(self, lock_path: str) -> bool:
+        # the stale lock is renamed away first, of several instances only one succeeds,
+        # a lock renewed or recreated in the meantime is put back
+        try:
+            if time.time() - os.stat(lock_path).st_mtime <= CLUSTER_LEASE_TTL:
+                return False
+            stale_path = f'{lock_path}.{CLUSTER_INSTANCE}.stale'
+            os.rename(lock_path, stale_path)
+        except FileNotFoundError:
+            return False
+        if time.time() - os.stat(stale_path).st_mtime <= CLUSTER_LEASE_TTL:
+            try:
+                os.link(stale_path, lock_path)
+            except FileExistsError:
+                pass
+            os.remove(stale_path)
+            return False
+        logger.warning(f'Lease {os.path.basename(lock_path)} of {read_owner(stale_path)} expired, taken over')
+        os.remove(stale_path)
+        return True
+
+    def __remove(self, lock_path: str) -> None:
+        # a lease taken over by another instance is not ours to remove
+        if read_owner(lock_path) == CLUSTER_INSTANCE:
+            try:
+                os.remove(lock_path)
+            except FileNotFoundError:
+                pass
+
+    def __renew(self, stopped: threading.Event) -> None:
+        while not stopped.wait(CLUSTER_LEASE_TTL / 3):
+            with self.lock:
+                lock_paths = list(self.held.values())
+            for lock_path in lock_paths:
+                try:
+                    os.utime(lock_path)
+                except OSError as e:
+                    logger.error(f'Lease {os.path.basename(lock_path)} can not be renewed: {str(e)}')
+
+    def __prune_rtimes(self, before: int) -> None:
+        self.pruned = True
+        for entry in os.scandir(RTIMES_DIR):
+            if entry.name.isdigit() and int(entry.name) < before:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+
+def file_key(file: File) -> str:
+    # relative to WORK_DIR, instances may mount the shared directory at different paths
+    return hashlib.sha1(os.path.relpath(file.path, WORK_DIR).encode('utf-8')).hexdigest()
+
+
+def read_owner(lock_path: str) -> Optional[str]:
+    try:
+        with open(lock_path, 'r', encoding='utf-8') as f:
+            return json.load(f).get('instance', None)
+    except (OSError, ValueError):
+        return None
+
+
+def get_done_status(file: File) -> Optional[EFileStatus]:
+    # status of this version (size, mtime) of the file if any instance finished it
+    try:
+        with open(os.path.join(DONE_DIR, file_key(file) + '.json'), 'r', encoding='utf-8') as f:
+            done = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if (done['size'], done['mtime']) != (file.size, file.mtime):
+        return None
+    return EFileStatus(done['status'])
+
+
+def mark_done(file: File, status: EFileStatus) -> None:
+    os.makedirs(DONE_DIR, exist_ok=True)
+    done_path = os.path.join(DONE_DIR, file_key(file) + '.json')
+    with open(f'{done_path}.{CLUSTER_INSTANCE}.tmp', 'w', encoding='utf-8') as f:
+        json.dump({'path': file.path, 'size': file.size, 'mtime': file.mtime, 'status': status.value
+                   , 'instance': CLUSTER_INSTANCE, 'rtime': file.rtime, 'uid': file.uid}, f, ensure_ascii=False)
+    os.replace(f'{done_path}.{CLUSTER_INSTANCE}.tmp', done_path)
+
+
+def release_files(files: List[File], status: Optional[EFileStatus]=None) -> None:
+    for file in files:
+        lease_keeper.release(file, status)
+
+
+lease_keeper = LeaseKeeper()
@@ -0,0 +1,67 @@
+import logging
+import os
+import sqlite3
+from datetime import datetime as dt
+from typing import Dict, List, Tuple
+
+from app import STATE_DIR
+from app.model import EFileStatus, File
+
+logger = logging.getLogger(__name__)
+
+LEDGER_PATH = os.path.join(STATE_DIR, 'files.sqlite')
+
+
+# processing state of every file seen in WORK_DIR, a file is picked up again once its size, mtime or inode change
+def connect_ledger() -> sqlite3.Connection:
+    os.makedirs(STATE_DIR, exist_ok=True)
+    connection = sqlite3.connect(LEDGER_PATH, timeout=60)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('CREATE TABLE IF NOT EXISTS files '
+                       '(path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, inode INTEGER, ctime INTEGER'
+                       ', status TEXT, uid TEXT, rtime INTEGER, updated TEXT)')
+    connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+    return connection
+
+
+def get_file_states() -> Dict[str, Tuple[int, int, int, EFileStatus]]:
+    connection = connect_ledger()
+    try:
+        rows = connection.execute('SELECT path, size, mtime, inode, status FROM files').fetchall()
+    finally:
+        connection.close()
+    return {path: (size, mtime, inode, EFileStatus(status)) for path, size, mtime, inode, status in rows}
+
+
+def record_files(files: List[File], status: EFileStatus) -> None:
+    if not files: return
+    updated = dt.now().isoformat()
+    connection = connect_ledger()
+    try:
+        with connection:
+            connection.executemany('INSERT OR REPLACE INTO files (path, size, mtime, inode, ctime, status, uid, rtime, updated) '
+                                   'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'
+                                   , ((file.path, file.size, file.mtime, file.inode, file.ctime
+                                       , status.value, file.uid, file.rtime, updated) for file in files))
+    finally:
+        connection.close()
+
+
+# set once the ledger was reconciled with the last ES bulk, even if ES was unreachable,
+# so an empty ledger (empty WORK_DIR) does not call ES on every scan
+def is_ledger_bootstrapped() -> bool:
+    connection = connect_ledger()
+    try:
+        row = connection.execute("SELECT value FROM meta WHERE key = 'bootstrapped'").fetchone()
+    finally:
+        connection.close()
+    return row is not None
+
+
+def mark_ledger_bootstrapped() -> None:
+    connection = connect_ledger()
+    try:
+        with connection:
+            connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('bootstrapped', ?)", (dt.now().isoformat(),))
+    finally:
+        connection.close()
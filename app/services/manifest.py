@@ -0,0 +1,61 @@
+import logging
+import os
+import sqlite3
+from typing import List, Sequence, Set
+
+from app import STATE_DIR
+from app.model import File
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_PATH = os.path.join(STATE_DIR, 'manifest.sqlite')
+SQLITE_MAX_VARIABLES = 900
+
+
+# content hash of every indexed document per source _id, hashes of a file being indexed
+# are staged under its uid and promoted only after the whole file is indexed
+def connect_manifest() -> sqlite3.Connection:
+    os.makedirs(STATE_DIR, exist_ok=True)
+    connection = sqlite3.connect(MANIFEST_PATH, timeout=60)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('CREATE TABLE IF NOT EXISTS documents '
+                       '(source TEXT NOT NULL, id TEXT NOT NULL, hash BLOB NOT NULL, PRIMARY KEY (source, id)) WITHOUT ROWID')
+    connection.execute('CREATE TABLE IF NOT EXISTS staged '
+                       '(uid TEXT NOT NULL, source TEXT NOT NULL, id TEXT NOT NULL, hash BLOB NOT NULL)')
+    connection.execute('CREATE INDEX IF NOT EXISTS staged_uid ON staged (uid)')
+    return connection
+
+
+def stage_changed_documents(connection: sqlite3.Connection, file: File
+                            , ids: Sequence[str], hashes: Sequence[bytes]) -> Set[int]:
+    # returns positions of new or changed documents and stages their hashes
+    known = {}
+    for start in range(0, len(ids), SQLITE_MAX_VARIABLES):
+        chunk = ids[start:start + SQLITE_MAX_VARIABLES]
+        query = 'SELECT id, hash FROM documents WHERE source = ? AND id IN ({})'.format(','.join('?' * len(chunk)))
+        known.update(connection.execute(query, (file.source.name, *chunk)).fetchall())
+    changed = set(i for i, (_id, hash) in enumerate(zip(ids, hashes)) if known.get(_id) != hash)
+    with connection:
+        connection.executemany('INSERT INTO staged (uid, source, id, hash) VALUES (?, ?, ?, ?)'
+                               , ((file.uid, file.source.name, ids[i], hashes[i]) for i in sorted(changed)))
+    return changed
+
+
+def commit_staged_documents(file: File) -> None:
+    connection = connect_manifest()
+    try:
+        with connection:
+            connection.execute('INSERT OR REPLACE INTO documents (source, id, hash) '
+                               'SELECT source, id, hash FROM staged WHERE uid = ? ORDER BY rowid', (file.uid,))
+            connection.execute('DELETE FROM staged WHERE uid = ?', (file.uid,))
+    finally:
+        connection.close()
+
+
+def discard_staged_documents(files: List[File]) -> None:
+    connection = connect_manifest()
+    try:
+        with connection:
+            connection.executemany('DELETE FROM staged WHERE uid = ?', ((file.uid,) for file in files))
+    finally:
+        connection.close()
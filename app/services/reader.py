@@ -1,79 +1,314 @@
 import logging
 import os
-from typing import Generator, Iterator, List, Tuple, Union
+import tempfile
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from itertools import chain, islice
+from typing import Any, Deque, Dict, Generator, Iterator, List, Optional, Sequence, Tuple, Union
 from datetime import datetime as dt
+import openpyxl
+from openpyxl.cell.cell import TYPE_ERROR, TYPE_NUMERIC
 import pandas as pd
 
-from app import FILE_EXTENSIONS, WORK_DIR
-from app.model import VALIDATOR_FIELD, NORMALIZER_FIELD, File, Source, SOURCES_EXPECTED_COLUMNS
+from app import CACHE_ENABLED, CLUSTER_ENABLED, DELTA_ENABLED, READER, READER_CHUNK_SIZE, READER_WORKERS, STATE_DIR
+from app.model import (HEADER_ROWS, NA_STRINGS, NORMALIZER_FIELD, READER_MODE, EFileStatus,
+                       SOURCES_EXPECTED_COLUMNS, VALIDATOR_FIELD, File, Source)
+from app.apis.utils.documents import build_bulk_batches, generate_header_fingerprint
 from app.apis.utils.helpers import generate_timestamp_hash
+from app.services.columnar import COLUMNAR_EXTENSIONS, PARQUET_EXTENSIONS, read_csv_file, read_parquet_file
+from app.services.cache import cache_workbook, get_cached_workbook, workbook_cache_key
+from app.services.leases import lease_keeper, release_files
+from app.services.ledger import record_files
+from app.services.manifest import connect_manifest
+from app.utils.metrics import timed
 
 
 logger = logging.getLogger(__name__)
 
-def scan_for_new_files() -> List[File] :
-    files: List[File] = []
-    timestamp = obtain_last_indexed_timestamp()
-    logger.info(f'Last indexed time: {timestamp if not timestamp else dt.fromtimestamp(timestamp).isoformat()}')
-    
-    for file_name in os.listdir(WORK_DIR):
-        if not file_name.endswith(FILE_EXTENSIONS) or file_name.startswith('~$'): continue
-        
-        file_path = os.path.join(WORK_DIR, file_name)
-        file_ctime = int(os.path.getctime(file_path))
-        file_mtime = int(os.path.getmtime(file_path))
-        
-        if timestamp and (file_ctime < timestamp and file_mtime < timestamp): continue
-        
-        file = File(file_path, file_name, file_ctime)
-        files.append(file)
-    
-    files = sorted(files, key= lambda f: f.ctime, reverse=True)
-    return files
+STREAMING_EXTENSIONS = ('.xlsx', '.xlsm') # formats supported by openpyxl read-only mode
+# header fingerprint -> (source, header_idx, renamed columns), None for headers of unknown files
+HEADER_FINGERPRINTS: Dict[str, Union[Tuple[Source, int, List[str]], None]] = {}
 
-
-def get_df_with_source(file: File) -> Union[Tuple[pd.DataFrame, Source], Union[None, None]]:
-    df = pd.read_excel(file.path, header=None, dtype=object)
+def detect_source(header_rows: List[Sequence]) -> Union[Tuple[Source, int, List[str]], None]:
+    fingerprint = generate_header_fingerprint(header_rows)
+    if fingerprint in HEADER_FINGERPRINTS:
+        return HEADER_FINGERPRINTS[fingerprint]
+    match = None
     for source, item in SOURCES_EXPECTED_COLUMNS.items():
         header_idx = item.get('header_idx')
         expected_columns = item.get('columns')
+        if header_idx >= len(header_rows): continue
+        df_columns = list(header_rows[header_idx])
+        if all(expected_column in df_columns for expected_column in expected_columns):
+            old, new = item.get('rename')
+            match = (source, header_idx, [col.replace(old, new) for col in df_columns])
+            break
+    HEADER_FINGERPRINTS[fingerprint] = match
+    return match
+
+
+def get_df_with_source(file: File) -> Union[Tuple[pd.DataFrame, Source], Union[None, None]]:
+    # the workbook (and its shared strings) is loaded once, the source is detected from its first rows and
+    # read_excel parses the body from the same open workbook, formats openpyxl can not open use read_excel's engine
+    if not file.path.endswith(STREAMING_EXTENSIONS):
+        header_df = pd.read_excel(file.path, header=None, dtype=object, nrows=HEADER_ROWS)
+        match = detect_source(header_df.values.tolist())
+        if match is None:
+            return None, None
+        source, header_idx, columns = match
+        df = pd.read_excel(file.path, header=None, dtype=object, skiprows=header_idx + 1)
+    else:
+        wb = openpyxl.load_workbook(file.path, read_only=True, data_only=True, keep_links=False)
         try:
-            df_columns = df.iloc[header_idx].values
-        except IndexError:
-            continue
-        if all(expected_column in df_columns for expected_column in expected_columns): 
-            new_df = df.iloc[header_idx + 1:]
-            if source == Source.SAP_ANALYZER:
-                new_df.columns = [col.replace('.', '') for col in df_columns]
-            else: 
-                new_df.columns = [col.replace('.', '_') for col in df_columns]
-                
-            return new_df, source
-    return None, None
-
-
-def read_files() -> Generator[Tuple[Iterator, File], None, None]:
-    files = scan_for_new_files()
+            match = detect_source(__head_rows(wb))
+            if match is None:
+                return None, None
+            source, header_idx, columns = match
+            df = pd.read_excel(wb, engine='openpyxl', header=None, dtype=object, skiprows=header_idx + 1)
+        finally:
+            wb.close()
+    df = df.reindex(columns=range(len(columns)))
+    df.columns = columns
+    return df, source
+
+
+def __head_rows(wb: openpyxl.Workbook) -> List[Tuple]:
+    # first rows as read_excel(nrows=HEADER_ROWS) gives them: trailing empty cells dropped, rows padded to the widest
+    head = []
+    for row in islice(wb.worksheets[0].iter_rows(), HEADER_ROWS):
+        values = [__convert_cell(cell) for cell in row]
+        while values and values[-1] in (None, ''):
+            values.pop()
+        head.append(values)
+    width = max((len(values) for values in head), default=0)
+    return [tuple(values + [None] * (width - len(values))) for values in head]
+
+
+def get_columnar_df_with_source(file: File) -> Union[Tuple[pd.DataFrame, Source], Union[None, None]]:
+    # parquet keeps the header row as column names, so only sources with header_idx 0 are detected
+    if file.path.endswith(PARQUET_EXTENSIONS):
+        df = read_parquet_file(file.path)
+        header_rows, skip = [list(df.columns)], 0
+    else:
+        df = read_csv_file(file.path)
+        header_rows, skip = df.iloc[:HEADER_ROWS].values.tolist(), None
+    match = detect_source(header_rows)
+    if match is None:
+        return None, None
+    source, header_idx, columns = match
+    df = df.iloc[header_idx + 1 if skip is None else skip:].set_axis(range(len(df.columns)), axis=1)
+    df = df.reset_index(drop=True).reindex(columns=range(len(columns)))
+    df.columns = columns
+    return df, source
+
+
+def get_frames_with_source(file: File) -> Union[Tuple[Iterator[pd.DataFrame], Source], Union[None, None]]:
+    # read-only workbook is parsed lazily, so only the rows pulled from the iterator are held in memory
+    wb = openpyxl.load_workbook(file.path, read_only=True, data_only=True)
+    rows = (tuple(__convert_cell(cell) for cell in row) for row in wb.worksheets[0].iter_rows())
+    head = list(islice(rows, HEADER_ROWS))
+    match = detect_source(head)
+    if match is None:
+        wb.close()
+        return None, None
+    source, header_idx, columns = match
+    return __stream_frames(wb, columns, chain(head[header_idx + 1:], rows)), source
+
+
+def __convert_cell(cell) -> Any:
+    # same conversion as pandas read_excel, so both reader modes produce identical documents
+    if cell.data_type == TYPE_ERROR:
+        return None
+    if cell.data_type == TYPE_NUMERIC and cell.value is not None:
+        value = int(cell.value)
+        return value if value == cell.value else float(cell.value)
+    if isinstance(cell.value, str) and cell.value in NA_STRINGS: # 'NA', 'null', ... read_excel parses them as NaN
+        return None
+    return cell.value
+
+
+def __stream_frames(wb: openpyxl.Workbook, columns: List[str], rows: Iterator[Tuple]) -> Iterator[pd.DataFrame]:
+    try:
+        while True:
+            chunk = list(islice(rows, READER_CHUNK_SIZE))
+            if not chunk: break
+            df = pd.DataFrame(chunk, dtype=object).reindex(columns=range(len(columns)))
+            df.columns = columns
+            yield df
+    finally:
+        wb.close()
+
+
+def __chunk_frame(df: pd.DataFrame) -> Iterator[pd.DataFrame]:
+    for start in range(0, len(df), READER_CHUNK_SIZE):
+        yield df.iloc[start:start + READER_CHUNK_SIZE]
+
+
+def read_file(file: File) -> Union[Iterator[pd.DataFrame], None]:
+    # identifies the source and fills the source fields of the file, None if it is not a valid source file
+    with timed(file, 'read'):
+        columnar = file.path.endswith(COLUMNAR_EXTENSIONS) # read faster than a cached workbook is loaded
+        cache_key = workbook_cache_key(file) if CACHE_ENABLED and not columnar else None
+        cached = get_cached_workbook(cache_key) if cache_key else None
+        if columnar:
+            df, source = get_columnar_df_with_source(file)
+            data = __chunk_frame(df) if source is not None else None
+        elif cached is not None:
+            df, source = cached
+            data = __chunk_frame(df)
+        elif READER == READER_MODE.STREAMING and file.path.endswith(STREAMING_EXTENSIONS):
+            data, source = get_frames_with_source(file) # streamed rows are never materialised, so not cached
+        else:
+            df, source = get_df_with_source(file)
+            data = __chunk_frame(df) if source is not None else None
+            if cache_key and source is not None:
+                cache_workbook(cache_key, file, df, source)
+    if source is None or source.value.get('_id') is None:
+        return None
+    file.source = source
+    file.id_field = source.value.get('_id')
+    file.row_validator = source.value.get(VALIDATOR_FIELD, None)
+    file.normalizer = source.value.get(NORMALIZER_FIELD, None)
+    return data
+
+
+def stamp_file(file: File, i: int) -> None:
+    if file.rtime is not None: # resumed backfill, documents keep their rtime and @uid
+        return
+    #! +i because if file read very fast, so timestamps would be same, so adding + i = + 1 second between files
+    timestamp = int(dt.now().timestamp()) + i
+    if CLUSTER_ENABLED: # other instances stamp files at the same time, every rtime is reserved once
+        timestamp = lease_keeper.reserve_rtime(timestamp)
+    file.rtime = timestamp
+    file.uid = generate_timestamp_hash(timestamp)
+
+
+def read_files(files: Optional[List[File]]=None) -> Generator[Tuple[Iterator[pd.DataFrame], File], None, None]:
+    if files is None:
+        files = scan_for_new_files()
     logger.info(f'Number of files to index: {len(files)}')
-    for i, file in enumerate(files):
+    for i, file in __claim_files(files):
         try:
-            df, source = get_df_with_source(file)
-            if source is None or source.value.get('_id') is None:
+            data = read_file(file)
+            if data is None:
                 logger.warning(f'File {file.name}, could not be identified as valid source file.')
+                record_files([file], EFileStatus.REJECTED)
+                release_files([file], EFileStatus.REJECTED)
                 continue
-            file.source = source
-            #! +i because if file read very fast, so timestamps would be same, so adding + i = + 1 second between files
-            timestamp = int(dt.now().timestamp()) + i
-            file.rtime = timestamp
-            file.uid = generate_timestamp_hash(timestamp)
-            file.id_field = source.value.get('_id')
-            file.row_validator = source.value.get(VALIDATOR_FIELD, None)
-            file.normalizer = source.value.get(NORMALIZER_FIELD, None)
-            data = iter(df.to_dict(orient='records', ))
+            stamp_file(file, i)
             yield (data, file)
         except Exception as e:
             logger.error(f'File {file.name} can not be read')
             logger.error(str(e))
+            record_files([file], EFileStatus.FAILED)
+            release_files([file])
             continue     
-        
-from app.services.es import obtain_last_indexed_timestamp
+
+
+def __claim_files(files: List[File]) -> Iterator[Tuple[int, File]]:
+    # in cluster mode only files this instance holds the lease for, claimed one at a time when the reader
+    # gets to them, so instances sharing WORK_DIR split the files between them
+    for i, file in enumerate(files):
+        if CLUSTER_ENABLED and not lease_keeper.claim(file):
+            logger.info(f'File {file.name} skipped, claimed or finished by another instance')
+            continue
+        yield i, file
+
+
+def read_batches(files: Optional[List[File]]=None) -> Generator[Tuple[Iterator[Tuple[bytes, int]], File], None, None]:
+    # yields (ndjson batches, file), files keep newest ctime first order in both modes
+    if files is None:
+        files = scan_for_new_files()
+    if READER_WORKERS > 1:
+        yield from __read_batches_on_workers(files)
+        return
+    for data, file in read_files(files):
+        yield __build_batches(data, file), file
+
+
+def __build_batches(data: Iterator[pd.DataFrame], file: File) -> Iterator[Tuple[bytes, int]]:
+    manifest = connect_manifest() if DELTA_ENABLED else None
+    try:
+        yield from build_bulk_batches(data, file, manifest)
+    finally:
+        if manifest is not None:
+            manifest.close()
+
+
+def __read_batches_on_workers(files: List[File]) -> Generator[Tuple[Iterator[Tuple[bytes, int]], File], None, None]:
+    # workers write the batches of a file to a temporary segment, only its index comes back through the pool,
+    # so the parent holds one batch at a time however many files are parsed ahead
+    logger.info(f'Number of files to index: {len(files)}, parsed on {READER_WORKERS} workers')
+    files_to_submit = __stamp_files(__claim_files(files))
+    futures: Deque[Future] = deque()
+    with ProcessPoolExecutor(max_workers=READER_WORKERS) as executor:
+        try:
+            for file in islice(files_to_submit, READER_WORKERS * 2): # bounded prefetch, segments wait on disk
+                futures.append(executor.submit(parse_file_to_batches, file))
+            while futures:
+                file, segment, error = futures.popleft().result()
+                next_file = next(files_to_submit, None)
+                if next_file is not None:
+                    futures.append(executor.submit(parse_file_to_batches, next_file))
+                if error is not None:
+                    logger.error(f'File {file.name} can not be read')
+                    logger.error(error)
+                    record_files([file], EFileStatus.FAILED)
+                    release_files([file])
+                    continue
+                if segment is None:
+                    logger.warning(f'File {file.name}, could not be identified as valid source file.')
+                    record_files([file], EFileStatus.REJECTED)
+                    release_files([file], EFileStatus.REJECTED)
+                    continue
+                yield __read_segment(*segment), file
+        finally: # pipeline stopped early, segments of files parsed ahead are removed
+            for future in futures:
+                if not future.cancel() and future.exception() is None and future.result()[1] is not None:
+                    __remove_segment(future.result()[1][0])
+
+
+def __read_segment(path: str, batches: List[Tuple[int, int]]) -> Iterator[Tuple[bytes, int]]:
+    try:
+        with open(path, 'rb') as f:
+            for length, n_items in batches:
+                yield f.read(length), n_items
+    finally:
+        __remove_segment(path)
+
+
+def __remove_segment(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def __stamp_files(files: Iterator[Tuple[int, File]]) -> Iterator[File]:
+    for i, file in files: # stamped before submitting, rtime/uid stay unique and ordered
+        stamp_file(file, i)
+        yield file
+
+
+def parse_file_to_batches(file: File) -> Tuple[File, Union[Tuple[str, List[Tuple[int, int]]], None], Union[str, None]]:
+    # runs in a worker process, pre-encoded ndjson batches are written to a segment in STATE_DIR,
+    # returns (segment path, [(length, n_items)]) instead of the batches themselves
+    path = None
+    try:
+        data = read_file(file)
+        if data is None:
+            return file, None, None
+        os.makedirs(os.path.join(STATE_DIR, 'batches'), exist_ok=True)
+        fd, path = tempfile.mkstemp(prefix=f'{file.uid}_', suffix='.ndjson', dir=os.path.join(STATE_DIR, 'batches'))
+        batches = []
+        with os.fdopen(fd, 'wb') as f:
+            for bulk_data, n_items in __build_batches(data, file):
+                f.write(bulk_data)
+                batches.append((len(bulk_data), n_items))
+        return file, (path, batches), None
+    except Exception as e:
+        if path is not None:
+            __remove_segment(path)
+        return file, None, str(e)
+
+from app.services.scanner import scan_for_new_files
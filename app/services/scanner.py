@@ -0,0 +1,68 @@
+import logging
+import os
+from datetime import datetime as dt
+from typing import Dict, Iterator, List
+
+from app import CLUSTER_ENABLED, FILE_EXTENSIONS, RECONCILE_WITH_ES, RECURSIVE_SCAN, SPOOL, WORK_DIR
+from app.model import SPOOL_MODE, EFileStatus, File
+from app.services.leases import get_done_status
+from app.services.ledger import get_file_states, is_ledger_bootstrapped, mark_ledger_bootstrapped, record_files
+
+# split from reader, a run without new files does not import pandas
+logger = logging.getLogger(__name__)
+
+
+def scan_for_new_files() -> List[File] :
+    # local diff against the file ledger, no network call unless reconciliation with ES is enabled or the ledger
+    # is new, a new ledger is bootstrapped once from the last bulk, so files indexed before it are not sent again
+    files: List[File] = []
+    states = get_file_states()
+    adopted: List[File] = []
+    finished: Dict[EFileStatus, List[File]] = {}
+    # spooling everything is for boxes which can not reach ES, the ledger of the replaying box reconciles
+    offline = SPOOL == SPOOL_MODE.ALWAYS
+    bootstrap = not offline and not RECONCILE_WITH_ES and not states and not is_ledger_bootstrapped()
+    reconcile = not offline and (RECONCILE_WITH_ES or bootstrap)
+    timestamp = obtain_last_indexed_timestamp(required=not bootstrap) if reconcile else None
+    if bootstrap: # whatever ES returned, an unreachable ES bootstraps an empty ledger
+        mark_ledger_bootstrapped()
+    if reconcile:
+        logger.info(f'Last indexed time: {timestamp if not timestamp else dt.fromtimestamp(timestamp).isoformat()}')
+    
+    for entry in __scan_dir(WORK_DIR):
+        stat = entry.stat()
+        file = File(entry.path, entry.name, stat.st_ctime)
+        file.size, file.mtime, file.inode = stat.st_size, stat.st_mtime_ns, stat.st_ino
+        state = states.get(entry.path, None)
+        if state is not None:
+            size, mtime, inode, status = state
+            if (size, mtime, inode) == (file.size, file.mtime, file.inode) and status != EFileStatus.FAILED: continue
+        elif timestamp and (stat.st_ctime < timestamp and stat.st_mtime < timestamp):
+            adopted.append(file) # indexed before the ledger existed
+            continue
+        if CLUSTER_ENABLED:
+            status = get_done_status(file)
+            if status is not None: # finished by another instance
+                finished.setdefault(status, []).append(file)
+                continue
+        files.append(file)
+    
+    record_files(adopted, EFileStatus.INDEXED)
+    for status, finished_files in finished.items():
+        record_files(finished_files, status)
+    files = sorted(files, key= lambda f: f.ctime, reverse=True)
+    return files
+
+
+def __scan_dir(path: str) -> Iterator[os.DirEntry]:
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if RECURSIVE_SCAN:
+                    yield from __scan_dir(entry.path)
+                continue
+            if not entry.name.endswith(FILE_EXTENSIONS) or entry.name.startswith('~$'): continue
+            yield entry
+
+
+from app.services.es import obtain_last_indexed_timestamp
@@ -0,0 +1,136 @@
+import gzip
+import json
+import logging
+import mmap
+import os
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from app import DELTA_ENABLED, SPOOL_COMPRESSION, SPOOL_COMPRESSION_LEVEL, SPOOL_DIR
+from app.model import NORMALIZER_FIELD, VALIDATOR_FIELD, File, Source
+from app.services.manifest import discard_staged_documents
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_EXTENSION = '.ndjson'
+META_EXTENSION = '.json'
+# file path -> metas of its spooled segments, read from SPOOL_DIR once per process and kept up to date after
+SPOOLED_BY_PATH: Optional[Dict[str, List[Dict]]] = None
+
+
+# finished ndjson batches of one file, appended to <rtime>_<uid>.ndjson while the file is being bulked,
+# the meta file is written last, so segments without meta (crashed runs) are never replayed
+class SpoolSegment():
+    def __init__(self, file: File) -> None:
+        os.makedirs(SPOOL_DIR, exist_ok=True)
+        self.file = file
+        self.name = f'{file.rtime}_{file.uid}'
+        self.path = os.path.join(SPOOL_DIR, self.name + SEGMENT_EXTENSION)
+        self.handle = open(self.path, 'wb')
+        self.batches: List[Tuple[int, int, int]] = [] # (offset, length, n_items)
+
+    def append(self, bulk_data: bytes, n_items: int) -> None:
+        if SPOOL_COMPRESSION == 'gzip': # every batch on its own, so batches can be replayed one by one
+            bulk_data = gzip.compress(bulk_data, compresslevel=SPOOL_COMPRESSION_LEVEL)
+        self.batches.append((self.handle.tell(), len(bulk_data), n_items))
+        self.handle.write(bulk_data)
+
+    def close(self) -> None:
+        self.handle.close()
+        file = self.file
+        meta = {'path': file.path, 'name': file.name, 'ctime': file.ctime, 'size': file.size, 'mtime': file.mtime
+                , 'inode': file.inode, 'rtime': file.rtime, 'uid': file.uid, 'source': file.source.name
+                , 'n_skipped': file.n_skipped, 'compression': SPOOL_COMPRESSION, 'batches': self.batches}
+        meta_path = os.path.join(SPOOL_DIR, self.name + META_EXTENSION)
+        with open(meta_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(meta_path + '.tmp', meta_path)
+        spooled = get_spooled_by_path()
+        for older in spooled.pop(file.path, []): # a newer export of the same file supersedes older spooled data
+            if older['key'] != self.name:
+                remove_spooled_file(older['key'])
+                if DELTA_ENABLED:
+                    discard_staged_documents([spooled_file(older)])
+        spooled[file.path] = [{**meta, 'key': self.name}]
+        logger.info(f'File {file.name} spooled: {sum(n for _, _, n in self.batches)} documents in {len(self.batches)} batches')
+
+    def discard(self) -> None:
+        self.handle.close()
+        remove_spooled_file(self.name)
+
+
+def list_spooled_files() -> List[Dict]:
+    # newest file ctime first, same order as files of a regular run
+    entries = []
+    if not os.path.isdir(SPOOL_DIR):
+        return entries
+    for entry in os.scandir(SPOOL_DIR):
+        if not entry.name.endswith(META_EXTENSION): continue
+        try:
+            with open(entry.path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            continue
+        meta['key'] = entry.name[:-len(META_EXTENSION)]
+        entries.append(meta)
+    return sorted(entries, key=lambda meta: meta['ctime'], reverse=True)
+
+
+def get_spooled_by_path() -> Dict[str, List[Dict]]:
+    global SPOOLED_BY_PATH
+    if SPOOLED_BY_PATH is None:
+        SPOOLED_BY_PATH = {}
+        for meta in list_spooled_files():
+            SPOOLED_BY_PATH.setdefault(meta['path'], []).append(meta)
+    return SPOOLED_BY_PATH
+
+
+def spooled_file(meta: Dict) -> File:
+    # File as it was when spooled, rtime and uid are kept, so replayed documents are identical
+    file = File(meta['path'], meta['name'], meta['ctime'])
+    file.size, file.mtime, file.inode = meta['size'], meta['mtime'], meta['inode']
+    file.rtime, file.uid = meta['rtime'], meta['uid']
+    file.source = Source[meta['source']]
+    file.id_field = file.source.value.get('_id')
+    file.row_validator = file.source.value.get(VALIDATOR_FIELD, None)
+    file.normalizer = file.source.value.get(NORMALIZER_FIELD, None)
+    file.n_skipped = meta['n_skipped']
+    return file
+
+
+def read_spooled_batches(meta: Dict) -> Iterator[Tuple[bytes, int]]:
+    # the segment is memory-mapped, only the batch being sent is copied out of the page cache
+    if not meta['batches']:
+        return
+    with open(os.path.join(SPOOL_DIR, meta['key'] + SEGMENT_EXTENSION), 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as segment:
+            for offset, length, n_items in meta['batches']:
+                bulk_data = segment[offset:offset + length]
+                yield (gzip.decompress(bulk_data) if meta['compression'] == 'gzip' else bulk_data), n_items
+
+
+def remove_spooled_file(key: str) -> None:
+    if SPOOLED_BY_PATH is not None:
+        for path, metas in list(SPOOLED_BY_PATH.items()):
+            SPOOLED_BY_PATH[path] = [meta for meta in metas if meta['key'] != key]
+    for name in (key + META_EXTENSION, key + SEGMENT_EXTENSION):
+        try:
+            os.remove(os.path.join(SPOOL_DIR, name))
+        except FileNotFoundError:
+            pass
+
+
+def open_spool_segment(file: File, segments: Dict[str, SpoolSegment]) -> SpoolSegment:
+    segment = segments.get(file.uid, None)
+    if segment is None:
+        segment = segments[file.uid] = SpoolSegment(file)
+    return segment
+
+
+def close_spool_segment(file: File, segments: Dict[str, SpoolSegment], keep: bool) -> None:
+    segment = segments.pop(file.uid, None)
+    if segment is None:
+        return
+    if keep:
+        segment.close()
+    else:
+        segment.discard()
@@ -0,0 +1,89 @@
+import logging
+import os
+import signal
+import sys
+import time
+from typing import Dict, List, Tuple, Union
+
+from app import (RECURSIVE_SCAN, WATCH_DEBOUNCE, WATCH_POLL_INTERVAL,
+                 WATCH_RETRY_INTERVAL, WORK_DIR, renew_timestamp)
+from app.model import File
+from app.services.es import bulk_files_to_es
+from app.services.scanner import scan_for_new_files
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError: # optional, WORK_DIR is polled instead
+    INotify = None
+
+logger = logging.getLogger(__name__)
+
+
+def watch_work_dir() -> None:
+    # one process, event loop and connection pool for the whole lifetime, every change in WORK_DIR
+    # is indexed once the file stopped changing for WATCH_DEBOUNCE seconds
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    inotify = __open_inotify()
+    logger.info(f'Watching {WORK_DIR} ({"inotify" if inotify else "polling"})')
+    candidates: Dict[str, Tuple[int, int, float]] = {} # path -> (size, mtime, unchanged since)
+    processed: Dict[str, Tuple[int, int, float]] = {} # path -> (size, mtime, processed at)
+    try:
+        while True:
+            ready: List[File] = []
+            try:
+                ready = __stable_files(scan_for_new_files(), candidates, processed)
+                if ready:
+                    renew_timestamp()
+                    bulk_files_to_es(ready)
+            except Exception as e: # e.g. elasticsearch unreachable, the daemon keeps running
+                logger.error(f'Watch cycle failed, files retried in {WATCH_RETRY_INTERVAL}s: {str(e)}', exc_info=True)
+            now = time.monotonic() # failed files too, so they are retried after WATCH_RETRY_INTERVAL
+            for file in ready:
+                processed[file.path] = (file.size, file.mtime, now)
+            timeout = WATCH_DEBOUNCE if candidates else WATCH_POLL_INTERVAL
+            if inotify is not None:
+                inotify.read(timeout=int(timeout * 1000), read_delay=100)
+            else:
+                time.sleep(timeout)
+    finally:
+        if inotify is not None:
+            inotify.close()
+
+
+def __stable_files(files: List[File], candidates: Dict[str, Tuple[int, int, float]]
+                   , processed: Dict[str, Tuple[int, int, float]]) -> List[File]:
+    now = time.monotonic()
+    ready: List[File] = []
+    for file in files:
+        signature = (file.size, file.mtime)
+        last_processed = processed.get(file.path, None)
+        if last_processed and last_processed[:2] == signature and now - last_processed[2] < WATCH_RETRY_INTERVAL:
+            continue # failed recently and did not change since
+        candidate = candidates.get(file.path, None)
+        if candidate is None or candidate[:2] != signature:
+            candidates[file.path] = (*signature, now)
+            continue
+        if now - candidate[2] < WATCH_DEBOUNCE: continue
+        lock_file = os.path.join(os.path.dirname(file.path), '~$' + file.name)
+        if os.path.exists(lock_file): continue # still open in excel
+        ready.append(file)
+    for path in (set(candidates) - set(file.path for file in files)) | set(file.path for file in ready):
+        candidates.pop(path, None)
+    return sorted(ready, key=lambda f: f.ctime, reverse=True)
+
+
+def __open_inotify() -> Union['INotify', None]:
+    if INotify is None:
+        return None
+    try:
+        inotify = INotify()
+        mask = flags.CREATE | flags.CLOSE_WRITE | flags.MOVED_TO | flags.DELETE | flags.MODIFY
+        inotify.add_watch(WORK_DIR, mask)
+        if RECURSIVE_SCAN:
+            for root, dirs, _ in os.walk(WORK_DIR):
+                for name in dirs:
+                    inotify.add_watch(os.path.join(root, name), mask)
+        return inotify
+    except OSError as e:
+        logger.warning(f'inotify not available, falling back to polling: {str(e)}')
+        return None
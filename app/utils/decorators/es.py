@@ -1,35 +1,49 @@
 import logging
 from functools import wraps
-from typing import Callable
+from typing import Callable, Dict
 
-from aiohttp import ClientConnectorError
-
-from app import es_hosts, base_es_url, es_headers, ssl
+from app import es_hosts, es_headers, ssl
+from app.apis.hosts import es_host_pool
+from app.apis.pool import es_pool
 from app.model import ESData
 
 logger = logging.getLogger(__name__)
 
 DEFAULT_HOST = 'localhost:9200'
 
+
+class ESUnavailableError(Exception):
+    pass
+ES_DATA: Dict[str, ESData] = {} # es url -> ESData bound to the current pooled session
+
+
+def get_es_data(es_url: str) -> ESData:
+    session = es_pool.session
+    es_data = ES_DATA.get(es_url, None)
+    if es_data is None or es_data.session is not session:
+        es_data = ESData(es_url, es_headers, ssl, session)
+        ES_DATA[es_url] = es_data
+    return es_data
+
+
 def use_multiple_es_hosts(fn: Callable) -> Callable:
     @wraps(fn)
     async def wrapper(*args, **kwargs):
-        i = 0
-        n = len(es_hosts) if es_hosts and isinstance(es_hosts, list) else 1 
-        condition = True if es_hosts and isinstance(es_hosts, list) and len(es_hosts) > 0 else False
-        if not condition:
+        from aiohttp import ClientConnectorError # loaded with the first request, not with the cli
+        if not (es_hosts and isinstance(es_hosts, list) and len(es_hosts) > 0):
             logger.info(f'Elasticsearch host NOT specified, default host used: {DEFAULT_HOST}')
-        while i < n:
+        for host in es_host_pool.candidates():
+            es_data = get_es_data(host.url)
+            host.outstanding += 1
             try:
-                es_url = es_hosts[i] if condition else base_es_url
-                es_data = ESData(es_url, es_headers, ssl)
                 es_func_response = await fn(es_data, *args, **kwargs)
-                break
             except ClientConnectorError as _:
-                host = es_hosts[i] if condition else DEFAULT_HOST
-                logger.error(f'ClientConnectorError Elasticsearch host {host} is unreachable')
-                if i == n - 1: 
-                    raise Exception('ClientConnectorError can not connect to any of the specified Elasticsearch hosts')
-                i += 1
-        return es_func_response
-    return wrapper
\ No newline at end of file
+                logger.error(f'ClientConnectorError Elasticsearch host {host.url} is unreachable')
+                es_host_pool.mark_failure(host)
+                continue
+            finally:
+                host.outstanding -= 1
+            es_host_pool.mark_success(host)
+            return es_func_response
+        raise ESUnavailableError('ClientConnectorError can not connect to any of the specified Elasticsearch hosts')
+    return wrapper
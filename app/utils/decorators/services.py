@@ -3,24 +3,37 @@ import logging
 import time
 from functools import wraps
 import traceback
-from typing import Callable
+from typing import Callable, Union
+
+from app.utils.metrics import run_metrics
 
 logger = logging.getLogger(__name__)
 
+event_loop: Union[asyncio.AbstractEventLoop, None] = None
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    # one loop for all services of the process, created with the first service call instead of on import of app
+    global event_loop
+    if event_loop is None or event_loop.is_closed():
+        event_loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(event_loop)
+    return event_loop
+
 
 def service(fn: Callable) -> Callable:
     @wraps(fn)
     def wrapper(*args, **kwargs):
-        begin = time.time()
+        begin = time.perf_counter()
         try:
-            loop = asyncio.get_event_loop()
+            loop = get_event_loop()
             result = fn(loop, *args, **kwargs)
         except Exception as e:
             logger.error(f'Exception in service wrapper: {str(e)}')
             traceback.print_exc()
             raise e
         finally:
-            pass
+            run_metrics.observe_service(fn.__name__.strip('_'), time.perf_counter() - begin)
             # logger.info('Event loop at {} finished after: {}'.format(fn.__name__, time.time() - begin))
         return result
     return wrapper
\ No newline at end of file
@@ -0,0 +1,152 @@
+import bisect
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+from app.model import FILE_COUNTERS, FILE_STAGES, BulkResult, File
+from app.utils.profiling import profiled
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60) # seconds, +Inf is implicit
+PROMETHEUS_PREFIX = 'st_data_indexer'
+
+
+@contextmanager
+def timed(file: File, stage: str) -> Iterator[None]:
+    begin = time.perf_counter()
+    try:
+        with profiled(stage, file.name):
+            yield
+    finally:
+        file.metrics[stage] += time.perf_counter() - begin
+
+
+def timed_iter(file: File, stage: str, iterable: Iterable) -> Iterator:
+    # times only producing the items, not the consumer working between them
+    iterator = iter(iterable)
+    while True:
+        with timed(file, stage):
+            item = next(iterator, StopIteration)
+        if item is StopIteration:
+            return
+        yield item
+
+
+class HostLatency():
+    def __init__(self) -> None:
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        buckets, total = [], 0
+        for le, count in zip(LATENCY_BUCKETS + ('+Inf',), self.counts):
+            total += count
+            buckets.append((str(le), total))
+        return buckets
+
+
+# run wide counters, per file numbers are summed from file.metrics when the file is finished
+class RunMetrics():
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        self.started = time.time()
+        self.begin = time.perf_counter()
+        self.stages = {stage: 0.0 for stage in FILE_STAGES}
+        self.services: Dict[str, float] = {}
+        self.counters = {counter: 0 for counter in FILE_COUNTERS}
+        self.statuses: Dict[str, int] = {}
+        self.hosts: Dict[str, HostLatency] = {}
+        self.files: List[Dict] = []
+
+    def observe_service(self, name: str, seconds: float) -> None:
+        self.services[name] = self.services.get(name, 0.0) + seconds
+
+    def observe_request(self, host: str, file: File, rtt: float, took_ms: float, n_bytes: int, retry: bool) -> None:
+        self.hosts.setdefault(host, HostLatency()).observe(rtt)
+        file.metrics['network'] += rtt
+        file.metrics['took'] += (took_ms or 0) / 1000
+        file.metrics['requests'] += 1
+        file.metrics['retries'] += int(retry)
+        file.metrics['bytes'] += n_bytes
+
+    def observe_file(self, bulk_result: BulkResult) -> Dict:
+        file = bulk_result.file
+        for stage in FILE_STAGES:
+            self.stages[stage] += file.metrics[stage]
+        for counter in self.counters:
+            self.counters[counter] += file.metrics[counter]
+        status = bulk_result.status.value
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        summary = file_summary(file)
+        self.files.append({'file': file.name, 'status': status, **summary})
+        return summary
+
+    def report(self) -> Dict:
+        duration = time.perf_counter() - self.begin
+        return {
+            'started': self.started
+            ,'duration': round(duration, 3)
+            ,'rows_per_sec': round(self.counters['rows'] / duration, 1) if duration else None
+            ,'stages': {stage: round(seconds, 3) for stage, seconds in self.stages.items()}
+            ,'services': {name: round(seconds, 3) for name, seconds in self.services.items()}
+            ,**self.counters
+            ,'files': self.statuses
+            ,'hosts': {host: {'count': latency.count, 'sum': round(latency.sum, 3), 'buckets': dict(latency.cumulative())}
+                       for host, latency in self.hosts.items()}
+            ,'per_file': self.files
+        }
+
+    def prometheus(self) -> str:
+        # textfile collector format, per file numbers are left out to keep the cardinality low
+        p = PROMETHEUS_PREFIX
+        report = self.report()
+        lines = [f'# TYPE {p}_run_timestamp_seconds gauge', f'{p}_run_timestamp_seconds {self.started}'
+                 , f'# TYPE {p}_run_duration_seconds gauge', f'{p}_run_duration_seconds {report["duration"]}'
+                 , f'# TYPE {p}_rows_per_second gauge', f'{p}_rows_per_second {report["rows_per_sec"] or 0}'
+                 , f'# TYPE {p}_stage_seconds gauge']
+        lines += [f'{p}_stage_seconds{{stage="{stage}"}} {seconds}' for stage, seconds in report['stages'].items()]
+        lines.append(f'# TYPE {p}_service_seconds gauge')
+        lines += [f'{p}_service_seconds{{service="{name}"}} {seconds}' for name, seconds in report['services'].items()]
+        for counter in self.counters:
+            lines += [f'# TYPE {p}_{counter} gauge', f'{p}_{counter} {self.counters[counter]}']
+        lines.append(f'# TYPE {p}_files gauge')
+        lines += [f'{p}_files{{status="{status}"}} {n}' for status, n in self.statuses.items()]
+        lines.append(f'# TYPE {p}_request_duration_seconds histogram')
+        for host, latency in self.hosts.items():
+            lines += [f'{p}_request_duration_seconds_bucket{{host="{host}",le="{le}"}} {n}' for le, n in latency.cumulative()]
+            lines += [f'{p}_request_duration_seconds_sum{{host="{host}"}} {latency.sum}'
+                      , f'{p}_request_duration_seconds_count{{host="{host}"}} {latency.count}']
+        return '\n'.join(lines) + '\n'
+
+    def write_report(self, path: str, format: str) -> None:
+        # written atomically, a textfile collector must never see a partial file
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        content = self.prometheus() if format == 'prometheus' else json.dumps(self.report(), ensure_ascii=False, indent=2)
+        with open(f'{path}.tmp', 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(f'{path}.tmp', path)
+        logger.info(f'Run metrics written to {path}')
+
+
+def file_summary(file: File) -> Dict:
+    processing = sum(file.metrics[stage] for stage in ('read', 'normalize', 'serialize', 'delta'))
+    summary = {key: round(value, 3) if isinstance(value, float) else value for key, value in file.metrics.items()}
+    summary['rows_per_sec'] = round(file.metrics['rows'] / processing, 1) if processing else None
+    return summary
+
+
+run_metrics = RunMetrics()
@@ -0,0 +1,198 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime as dt
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Set, Tuple
+
+if TYPE_CHECKING: # profilers are imported only when profiling is enabled
+    import cProfile
+    import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+# module imports (lazy pandas/openpyxl imports happen inside the first stage, recognized with tracemalloc_frames > 1)
+# and the profilers themselves
+IGNORED_ALLOCATIONS = ('<frozen importlib._bootstrap*>', '*/tracemalloc.py', '*/cProfile.py', '*/profile.py')
+
+
+def current_rss() -> int:
+    # bytes, /proc on linux, peak rss of the process elsewhere
+    try:
+        with open('/proc/self/statm', 'rb') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except OSError:
+        import resource
+        import sys
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+# cProfile stats and tracemalloc snapshots per stage, written as <stage>.prof (snakeviz, pstats, gprof2dot)
+# and tracemalloc.txt, per file peak rss is sampled on a background thread and written to rss.json;
+# only one profiler can be active per thread, so a nested stage pauses its parent and stages are exclusive
+class StageProfiler():
+    def __init__(self) -> None:
+        self.enabled = False
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.profiles: Dict[Tuple[str, int], 'cProfile.Profile'] = {} # (stage, thread id) -> profile
+        # stage -> (traced bytes, file of its largest snapshot), a snapshot copies every trace into python objects,
+        # so it is written out right away and read back one at a time by dump, once tracing stopped
+        self.snapshots: Dict[str, Tuple[int, str]] = {}
+        self.snapshot_dir: Optional[str] = None
+        self.snapshotted: Set[Tuple[str, Optional[str]]] = set() # (stage, file name) with a snapshot taken
+        self.rss_files: Dict[str, int] = {} # file name -> peak rss while it was read
+        self.rss_samples: List[Tuple[float, int, Optional[str]]] = []
+        self.current_file: Optional[str] = None
+        self.sampler: Optional[threading.Thread] = None
+        self.stopped = threading.Event()
+        self.dropped: Set[str] = set() # stages which could not be profiled at least once, warned about once
+
+    def start(self) -> None:
+        from app import PROFILING_RSS_INTERVAL, PROFILING_TRACEMALLOC, PROFILING_TRACEMALLOC_FRAMES, READER_WORKERS
+        import tracemalloc
+        if READER_WORKERS > 1:
+            logger.warning('Profiling covers this process only, files parsed on workers are not profiled, set export.workers to 0')
+        self.profiles, self.snapshots, self.rss_files, self.rss_samples = {}, {}, {}, []
+        self.dropped, self.snapshotted = set(), set()
+        self.current_file = None
+        self.started = time.perf_counter()
+        if PROFILING_TRACEMALLOC and not tracemalloc.is_tracing():
+            tracemalloc.start(PROFILING_TRACEMALLOC_FRAMES) # every frame is stored with every traced allocation
+        self.stopped.clear()
+        self.sampler = threading.Thread(target=self.__sample_rss, args=(PROFILING_RSS_INTERVAL,), name='rss-sampler', daemon=True)
+        self.sampler.start()
+        self.enabled = True
+
+    def stop(self) -> None:
+        import tracemalloc
+        self.enabled = False
+        self.stopped.set()
+        if self.sampler is not None:
+            self.sampler.join()
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    @contextmanager
+    def stage(self, name: str, file_name: Optional[str]=None) -> Iterator[None]:
+        if file_name is not None:
+            self.current_file = file_name
+        stack: List[Optional['cProfile.Profile']] = self.local.__dict__.setdefault('stack', [])
+        if stack and stack[-1] is not None:
+            stack[-1].disable()
+        profile = self.__profile(name)
+        try:
+            profile.enable()
+        except ValueError: # python 3.12+ allows one active profiler per process, a stage of another thread has it
+            profile = None
+            if name not in self.dropped:
+                self.dropped.add(name)
+                logger.warning(f'Stage {name} not profiled while another thread holds the profiler (python 3.12+)')
+        stack.append(profile)
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            self.__snapshot(name) # before the parent resumes, the snapshot is not part of its profile
+            stack.pop()
+            if stack and stack[-1] is not None:
+                try:
+                    stack[-1].enable()
+                except ValueError:
+                    pass
+
+    def __profile(self, name: str) -> 'cProfile.Profile':
+        import cProfile
+        key = (name, threading.get_ident())
+        profile = self.profiles.get(key, None)
+        if profile is None:
+            with self.lock:
+                profile = self.profiles[key] = cProfile.Profile()
+        return profile
+
+    def __snapshot(self, name: str) -> None:
+        # at most one snapshot per stage and file, stages like serialize end once per batch and a snapshot
+        # costs a copy of every trace, kept only when more memory is traced than in the stage's largest one
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            return
+        key = (name, self.current_file)
+        if key in self.snapshotted:
+            return
+        traced, _ = tracemalloc.get_traced_memory()
+        largest = self.snapshots.get(name, None)
+        if largest is None or traced > largest[0]:
+            with self.lock: # the reader thread and the event loop end stages concurrently
+                self.snapshotted.add(key)
+                if self.snapshot_dir is None:
+                    self.snapshot_dir = tempfile.mkdtemp(prefix='st-tracemalloc-')
+                snapshot_path = os.path.join(self.snapshot_dir, f'{name}.snapshot')
+                tracemalloc.take_snapshot().dump(snapshot_path)
+                self.snapshots[name] = (traced, snapshot_path)
+
+    def __sample_rss(self, interval: float) -> None:
+        while not self.stopped.wait(interval):
+            rss, file_name = current_rss(), self.current_file
+            self.rss_samples.append((round(time.perf_counter() - self.started, 3), rss, file_name))
+            if file_name is not None and rss > self.rss_files.get(file_name, 0):
+                self.rss_files[file_name] = rss
+
+    def dump(self, path: str) -> str:
+        # one directory per run, returns it
+        import pstats
+        import tracemalloc
+        from fnmatch import fnmatch
+        from app import PROFILING_TOP
+        directory = os.path.join(path, dt.now().strftime('%Y%m%d-%H%M%S-%f'))
+        os.makedirs(directory, exist_ok=True)
+        stages: Dict[str, pstats.Stats] = {}
+        for (name, _), profile in self.profiles.items():
+            profile.create_stats()
+            if not profile.stats: continue
+            if name in stages:
+                stages[name].add(profile)
+            else:
+                stages[name] = pstats.Stats(profile)
+        for name, stats in stages.items():
+            stats.dump_stats(os.path.join(directory, f'{name}.prof'))
+        ignored = IGNORED_ALLOCATIONS + (__file__,)
+        with open(os.path.join(directory, 'tracemalloc.txt'), 'w', encoding='utf-8') as f:
+            for name, (traced, snapshot_path) in self.snapshots.items():
+                snapshot = tracemalloc.Snapshot.load(snapshot_path)
+                if snapshot.traceback_limit > 1: # imports show in the outer frames of a trace only
+                    snapshot = snapshot.filter_traces([tracemalloc.Filter(False, pattern, all_frames=True)
+                                                       for pattern in ignored])
+                    statistics = snapshot.statistics('lineno')
+                else: # same result, filtering every trace takes seconds, the lines are filtered instead
+                    statistics = [statistic for statistic in snapshot.statistics('lineno')
+                                  if not any(fnmatch(statistic.traceback[0].filename, pattern) for pattern in ignored)]
+                f.write(f'# {name}: {traced / 1024 ** 2:.1f} MB traced at the end of the stage, '
+                        f'{sum(s.size for s in statistics) / 1024 ** 2:.1f} MB without imports, top {PROFILING_TOP} lines\n')
+                for statistic in statistics[:PROFILING_TOP]:
+                    f.write(f'{statistic}\n')
+                f.write('\n')
+        if self.snapshot_dir is not None:
+            shutil.rmtree(self.snapshot_dir, ignore_errors=True)
+            self.snapshot_dir = None
+        with open(os.path.join(directory, 'rss.json'), 'w', encoding='utf-8') as f:
+            json.dump({'peak': max((rss for _, rss, _ in self.rss_samples), default=current_rss())
+                       , 'files': self.rss_files, 'samples': self.rss_samples}, f, ensure_ascii=False)
+        return directory
+
+
+stage_profiler = StageProfiler()
+
+
+@contextmanager
+def profiled(stage: str, file_name: Optional[str]=None) -> Iterator[None]:
+    if not stage_profiler.enabled: # a flag check per call when profiling is off
+        yield
+        return
+    with stage_profiler.stage(stage, file_name):
+        yield
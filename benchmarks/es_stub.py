@@ -0,0 +1,81 @@
+import argparse
+import asyncio
+import gzip
+import json
+import random
+from typing import Dict
+
+from aiohttp import web
+
+# local stand-in for the elasticsearch endpoints the indexer calls, documents are counted, not stored
+# usage: python -m benchmarks.es_stub [--port 9299] [--latency 0.02] [--jitter 0.01] [--reject 0.01] [--took 5]
+
+
+def create_app(latency: float, jitter: float, reject: float, took: int, seed: int=0) -> web.Application:
+    rnd = random.Random(seed)
+    stats: Dict[str, int] = {'bulk': 0, 'bytes': 0, 'documents': 0, 'rejected': 0, 'doc': 0, 'search': 0}
+
+    async def delay() -> None:
+        seconds = latency + rnd.uniform(0, jitter)
+        if seconds > 0:
+            await asyncio.sleep(seconds)
+
+    async def bulk(request: web.Request) -> web.Response:
+        raw = await request.read()
+        stats['bulk'] += 1
+        stats['bytes'] += int(request.headers.get('Content-Length', len(raw)))
+        if raw[:2] == b'\x1f\x8b': # aiohttp decompresses gzip request bodies on its own, older versions do not
+            raw = gzip.decompress(raw)
+        await delay()
+        ledger = request.match_info.get('index', None) == 'st-data-indexer' # run results, not documents
+        items, errors = [], False
+        for action_line in raw.split(b'\n')[::2]:
+            if not action_line: continue
+            action, meta = next(iter(json.loads(action_line).items()))
+            if rnd.random() < reject:
+                items.append({action: {'_id': meta.get('_id'), 'status': 429
+                                       , 'error': {'type': 'es_rejected_execution_exception'}}})
+                stats['rejected'] += 1
+                errors = True
+            else:
+                items.append({action: {'_id': meta.get('_id'), 'status': 201, 'result': 'created'}})
+                stats['doc' if ledger else 'documents'] += 1
+        return web.json_response({'took': took, 'errors': errors, 'items': items})
+
+    async def doc(request: web.Request) -> web.Response:
+        await request.read()
+        stats['doc'] += 1
+        return web.json_response({'result': 'created'})
+
+    async def search(request: web.Request) -> web.Response:
+        await request.read()
+        stats['search'] += 1
+        return web.json_response({'hits': {'hits': []}})
+
+    async def get_stats(_: web.Request) -> web.Response:
+        return web.json_response(stats)
+
+    async def acknowledge(_: web.Request) -> web.Response:
+        return web.json_response({'acknowledged': True})
+
+    app = web.Application(client_max_size=1024 ** 3)
+    app.router.add_post('/_bulk', bulk)
+    app.router.add_post('/{index}/_bulk', bulk)
+    app.router.add_post('/{index}/_doc', doc)
+    app.router.add_post('/{index}/_search', search)
+    app.router.add_get('/_stub/stats', get_stats)
+    app.router.add_route('*', '/{tail:.*}', acknowledge) # settings, refresh, ...
+    return app
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local elasticsearch stand-in for benchmarks')
+    parser.add_argument('--port', type=int, default=9299)
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every bulk request')
+    parser.add_argument('--jitter', type=float, default=0, help='random extra seconds, uniform')
+    parser.add_argument('--reject', type=float, default=0, help='share of documents rejected with 429')
+    parser.add_argument('--took', type=int, default=5, help='took reported in bulk responses, ms')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    web.run_app(create_app(args.latency, args.jitter, args.reject, args.took, args.seed)
+                , host='127.0.0.1', port=args.port, print=None)
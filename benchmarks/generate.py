@@ -0,0 +1,77 @@
+import argparse
+import os
+import random
+from datetime import datetime as dt, timedelta
+from typing import Callable, Dict, List, Tuple
+
+import openpyxl
+
+# synthetic exports for every Source, headers cover SOURCES_EXPECTED_COLUMNS plus the _id, date and
+# normalized columns, values mimic the real exports (VAS serial dates, '#' nulls, mixed 'Total no notifs')
+# app is not imported, it loads its config from the working directory on import - keep headers in sync with app.model
+# usage: python -m benchmarks.generate <dir> <SAP|VAS|SAP_ANALYZER> <rows> [--seed 0]
+MAX_SHEET_ROWS = 1048575 # excel limit without the header, bigger exports are split into parts
+NULL = '#' # app.model.NULL_VALUES
+BASE_DATE = dt(2022, 1, 1)
+BASE_SERIAL = 44562.0 # 2022-01-01 as an excel serial date
+
+
+def __sap_row(rnd: random.Random, i: int) -> List:
+    begin = BASE_DATE + timedelta(minutes=rnd.randrange(0, 525600))
+    return [4000000 + i, f'Porucha {rnd.choice(("motora", "čerpadla", "ventilu", "snímača"))} {i % 997}'
+            , begin, begin + timedelta(minutes=rnd.randrange(5, 2880)), f'SK{rnd.randrange(10, 99)}-L{rnd.randrange(1, 9)}'
+            , round(rnd.uniform(0.1, 48), 2), NULL if rnd.random() < 0.2 else f'poznámka {i}']
+
+
+def __vas_row(rnd: random.Random, i: int) -> List:
+    serial = BASE_SERIAL + rnd.uniform(0, 365)
+    return [5000000 + i, f'Popis poruchy {i % 1013}', rnd.randrange(1, 99999), f'Stroj {rnd.randrange(1, 50)}'
+            , serial, serial + rnd.uniform(0, 1), NULL if rnd.random() < 0.1 else serial + rnd.uniform(0, 2)
+            , float(int(serial) + 3), serial + 4.25, NULL if rnd.random() < 0.3 else f'{rnd.randrange(0, 100)}%']
+
+
+def __sap_analyzer_row(rnd: random.Random, i: int) -> List:
+    notifs = rnd.choice((1, 1, 1, 2, '1', NULL, None, 1.0))
+    return [6000000 + i, f'Order description {i % 1009}', f'E{rnd.randrange(1000, 9999)}', f'C{rnd.randrange(1, 20)}'
+            , notifs, round(rnd.uniform(0, 1000), 2)]
+
+
+GENERATORS: Dict[str, Tuple[List[str], Callable[[random.Random, int], List]]] = {
+    'SAP': (['Zákazka', 'Kr.text', 'Začiatok poruchy', 'Koniec poruchy', 'Technické miesto', 'Trvanie', 'Poznámka']
+            , __sap_row)
+    ,'VAS': (['Údržbárska zákazka', 'Popis poruchy', 'VAS číslo', 'Stroj', 'Time', 'Prebratie SAP'
+             , 'Prebratie terminál', 'Uzatvorenie SAP', 'Ukoncenie VAS', 'Stav'], __vas_row)
+    ,'SAP_ANALYZER': (['Maintenance Order', 'Maintenance Order (Desc)', 'Employee', 'Company ID-EMP'
+                      , 'Total no notifs', 'Costs'], __sap_analyzer_row)
+}
+
+
+def generate_exports(directory: str, source: str, rows: int, seed: int=0) -> List[str]:
+    # deterministic for (source, rows, seed), existing files are reused
+    header, make_row = GENERATORS[source]
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for part, start in enumerate(range(0, rows, MAX_SHEET_ROWS)):
+        path = os.path.join(directory, f'{source.lower()}_{rows}_{seed}_{part}.xlsx')
+        paths.append(path)
+        if os.path.exists(path): continue
+        rnd = random.Random(f'{source}-{seed}-{part}')
+        wb = openpyxl.Workbook(write_only=True)
+        ws = wb.create_sheet()
+        ws.append(header)
+        for i in range(start, min(rows, start + MAX_SHEET_ROWS)):
+            ws.append(make_row(rnd, i))
+        wb.save(f'{path}.tmp')
+        os.replace(f'{path}.tmp', path)
+    return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generates synthetic SAP/VAS exports')
+    parser.add_argument('directory')
+    parser.add_argument('source', choices=list(GENERATORS))
+    parser.add_argument('rows', type=int)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    for path in generate_exports(args.directory, args.source, args.rows, args.seed):
+        print(path)
@@ -0,0 +1,209 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from copy import deepcopy
+from datetime import datetime as dt
+from typing import Dict, List, Optional
+
+import yaml
+
+from benchmarks.generate import generate_exports
+
+# end to end runs of main.py against the local ES stand-in, every run gets its own working directory
+# with generated config, results are appended to benchmarks/results/results.jsonl and compared to the
+# previous result of the same scenario, peak RSS is measured with wait4 so it is linux/macos only
+# usage: python -m benchmarks.run [scenario ...] [--repeat 3] [--history]
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_DIR = os.path.join(ROOT, 'benchmarks', '.data')
+RESULTS_PATH = os.path.join(ROOT, 'benchmarks', 'results', 'results.jsonl')
+
+# files: rows per source, app: overrides of config.app.yaml, es: stand-in options
+SCENARIOS: Dict[str, Dict] = {
+    'small': {'files': {'SAP': 1000, 'VAS': 1000, 'SAP_ANALYZER': 1000}, 'app': {}, 'es': {}}
+    ,'medium-pandas': {'files': {'SAP': 100000, 'VAS': 100000, 'SAP_ANALYZER': 100000}, 'app': {}, 'es': {}}
+    ,'medium-streaming': {'files': {'SAP': 100000, 'VAS': 100000, 'SAP_ANALYZER': 100000}
+                          , 'app': {'export': {'reader': 'streaming'}}, 'es': {}}
+    ,'medium-workers': {'files': {'SAP': 100000, 'VAS': 100000, 'SAP_ANALYZER': 100000}
+                        , 'app': {'export': {'workers': 4}}, 'es': {}}
+    ,'medium-gzip-latency': {'files': {'SAP': 100000, 'VAS': 100000, 'SAP_ANALYZER': 100000}
+                             , 'app': {'bulk': {'compression': 'gzip'}}, 'es': {'latency': 0.05, 'jitter': 0.05}}
+    ,'medium-rejections': {'files': {'SAP': 100000, 'VAS': 100000, 'SAP_ANALYZER': 100000}
+                           , 'app': {'bulk': {'retry': {'initial_backoff': 0.1}}}, 'es': {'reject': 0.05}}
+    ,'large-streaming': {'files': {'SAP': 3000000}, 'app': {'export': {'reader': 'streaming'}}, 'es': {}}
+}
+
+BASE_APP_CONFIG = {
+    'export': {'file_extensions': ['.xlsx'], 'bulk_action': 'index'}
+    ,'elasticsearch': {'headers': {'Content-Type': 'application/json'}}
+    ,'metrics': {'enabled': True, 'format': 'json'}
+}
+LOG_CONFIG = {
+    'version': 1
+    ,'handlers': {
+        'info_file_handler': {'class': 'logging.FileHandler', 'level': 'INFO', 'filename': 'logs/info.log'}
+        ,'error_file_handler': {'class': 'logging.FileHandler', 'level': 'ERROR', 'filename': 'logs/errors.log'}
+    }
+    ,'root': {'level': 'INFO', 'handlers': ['info_file_handler', 'error_file_handler']}
+}
+
+
+def run_scenario(name: str, scenario: Dict, keep: bool=False) -> Dict:
+    export_paths = [path for source, rows in scenario['files'].items()
+                    for path in generate_exports(DATA_DIR, source, rows)]
+    workspace = tempfile.mkdtemp(prefix=f'st-bench-{name}-')
+    port = __free_port()
+    stub = __start_stub(port, scenario['es'])
+    try:
+        __prepare_workspace(workspace, port, scenario['app'], export_paths)
+        with open(os.path.join(workspace, 'logs', 'stderr.log'), 'w+') as stderr:
+            begin = time.perf_counter()
+            process = subprocess.Popen([sys.executable, os.path.join(ROOT, 'main.py')], cwd=workspace
+                                       , env={**os.environ, 'ENV': 'development', 'PYTHONPATH': ROOT}
+                                       , stdout=subprocess.DEVNULL, stderr=stderr)
+            _, status, rusage = os.wait4(process.pid, 0) # rusage of main.py and its reaped worker processes
+            wall = time.perf_counter() - begin
+            process.returncode = os.waitstatus_to_exitcode(status)
+            if process.returncode != 0:
+                stderr.seek(0)
+                raise RuntimeError(f'scenario {name} failed with exit code {process.returncode}\n{stderr.read()[-2000:]}')
+        with open(os.path.join(workspace, 'metrics.json'), 'r', encoding='utf-8') as f:
+            report = json.load(f)
+        with urllib.request.urlopen(f'http://127.0.0.1:{port}/_stub/stats') as resp:
+            es_stats = json.load(resp)
+    finally:
+        stub.terminate()
+        stub.wait()
+        if not keep:
+            shutil.rmtree(workspace, ignore_errors=True)
+    peak_rss = rusage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024) # bytes on macos, kilobytes on linux
+    return {
+        'scenario': name
+        ,'timestamp': dt.now().isoformat(timespec='seconds')
+        ,'commit': __git_commit()
+        ,'python': platform.python_version()
+        ,'machine': platform.node()
+        ,'wall': round(wall, 3)
+        ,'duration': report['duration']
+        ,'rows': report['rows']
+        ,'documents': report['documents']
+        ,'rows_per_sec': round(report['rows'] / wall, 1) if wall else None
+        ,'peak_rss_mb': round(peak_rss / 1024 ** 2, 1)
+        ,'stages': report['stages']
+        ,'requests': report['requests']
+        ,'retries': report['retries']
+        ,'bytes': report['bytes']
+        ,'es_documents': es_stats['documents']
+    }
+
+
+def __prepare_workspace(workspace: str, port: int, app_overrides: Dict, export_paths: List[str]) -> None:
+    for directory in ('config', 'logs', 'export'):
+        os.makedirs(os.path.join(workspace, directory))
+    for path in export_paths:
+        os.symlink(path, os.path.join(workspace, 'export', os.path.basename(path)))
+    app_config = __merge(deepcopy(BASE_APP_CONFIG), app_overrides)
+    app_config['export']['absolute_path'] = os.path.join(workspace, 'export')
+    app_config['state'] = {'path': os.path.join(workspace, 'state')}
+    app_config['cache'] = {**app_config.get('cache', {}), 'path': os.path.join(workspace, 'cache')}
+    app_config['metrics']['path'] = os.path.join(workspace, 'metrics.json')
+    env_config = {'elasticsearch': {'url': f'http://127.0.0.1:{port}', 'hosts': [f'http://127.0.0.1:{port}']}}
+    for file_name, content in (('config.app.yaml', app_config), ('config.dev.yaml', env_config)
+                               , ('config.log.yaml', LOG_CONFIG)):
+        with open(os.path.join(workspace, 'config', file_name), 'w', encoding='utf-8') as f:
+            yaml.safe_dump(content, f, allow_unicode=True)
+    with open(os.path.join(workspace, 'config', '.env'), 'w') as f:
+        f.write('ENV=development\n')
+
+
+def __start_stub(port: int, options: Dict) -> subprocess.Popen:
+    args = [f'--{key}={value}' for key, value in options.items()]
+    stub = subprocess.Popen([sys.executable, '-m', 'benchmarks.es_stub', f'--port={port}', *args], cwd=ROOT)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.2):
+                return stub
+        except OSError:
+            time.sleep(0.1)
+    stub.terminate()
+    raise RuntimeError('ES stand-in did not start')
+
+
+def __merge(config: Dict, overrides: Dict) -> Dict:
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(config.get(key, None), dict):
+            __merge(config[key], value)
+        else:
+            config[key] = value
+    return config
+
+
+def __free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def __git_commit() -> Optional[str]:
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+        dirty = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT, text=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return f'{commit}-dirty' if dirty.strip() else commit
+
+
+def load_results() -> List[Dict]:
+    if not os.path.exists(RESULTS_PATH):
+        return []
+    with open(RESULTS_PATH, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def save_result(result: Dict) -> None:
+    os.makedirs(os.path.dirname(RESULTS_PATH), exist_ok=True)
+    with open(RESULTS_PATH, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(result, ensure_ascii=False) + '\n')
+
+
+def format_result(result: Dict, previous: Optional[Dict]=None) -> str:
+    line = (f'{result["scenario"]:<22} {result["commit"] or "-":<14} {result["rows"]:>9} rows  '
+            f'{result["rows_per_sec"]:>10.1f} rows/s  {result["peak_rss_mb"]:>8.1f} MB  '
+            + ' '.join(f'{stage} {seconds:.2f}s' for stage, seconds in result['stages'].items()))
+    if previous and previous.get('rows_per_sec'):
+        change = (result['rows_per_sec'] / previous['rows_per_sec'] - 1) * 100
+        line += f'  ({change:+.1f}% vs {previous["commit"]})'
+    return line
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='End to end indexing benchmarks')
+    parser.add_argument('scenarios', nargs='*', help=f'default: small, available: {", ".join(SCENARIOS)}')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per scenario, the fastest one is kept')
+    parser.add_argument('--history', action='store_true', help='print stored results and exit')
+    parser.add_argument('--no-save', action='store_true')
+    parser.add_argument('--keep', action='store_true', help='keep working directories for inspection')
+    args = parser.parse_args()
+
+    history = load_results()
+    if args.history:
+        for result in history:
+            print(format_result(result))
+        sys.exit(0)
+    for name in args.scenarios or ['small']:
+        if name not in SCENARIOS:
+            parser.error(f'unknown scenario {name}')
+        runs = [run_scenario(name, SCENARIOS[name], args.keep) for _ in range(args.repeat)]
+        result = max(runs, key=lambda run: run['rows_per_sec'])
+        previous = next((r for r in reversed(history) if r['scenario'] == name), None)
+        print(format_result(result, previous))
+        if not args.no_save:
+            save_result(result)
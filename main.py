@@ -1,7 +1,6 @@
-import logging
-from app.services.es import bulk_files_to_es
+import sys
 
-logger = logging.getLogger(__name__)
+from app.cli import main
 
 if __name__ == '__main__':
-    status = bulk_files_to_es()    
\ No newline at end of file
+    sys.exit(main())
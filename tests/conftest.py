@@ -0,0 +1,32 @@
+import os
+import tempfile
+
+# app reads its settings on first access, tests get a minimal config in a temporary directory
+# before any test module imports from app
+CONFIG_DIR = tempfile.mkdtemp(prefix='st-test-config-')
+CONFIG_FILES = {
+    '.env': 'ENV=test\n'
+    ,'config.log.yaml': ('version: 1\n'
+                         'handlers:\n'
+                         '  info_file_handler: {class: logging.FileHandler, filename: x, delay: true}\n'
+                         '  error_file_handler: {class: logging.FileHandler, filename: x, delay: true}\n'
+                         'root: {level: WARNING, handlers: []}\n')
+    ,'config.test.yaml': ('elasticsearch:\n' # unreachable, tests never talk to a real cluster
+                          '  url: http://127.0.0.1:1\n'
+                          '  hosts: [http://127.0.0.1:1]\n')
+    ,'config.app.yaml': ('export:\n'
+                         f'  absolute_path: {os.path.join(CONFIG_DIR, "export")}\n'
+                         "  file_extensions: ['.xlsx']\n"
+                         '  bulk_action: index\n'
+                         'elasticsearch:\n'
+                         '  headers: {Content-Type: application/json}\n'
+                         'state:\n'
+                         f'  path: {os.path.join(CONFIG_DIR, "state")}\n')
+}
+for name, content in CONFIG_FILES.items():
+    with open(os.path.join(CONFIG_DIR, name), 'w', encoding='utf-8') as f:
+        f.write(content)
+os.chdir(CONFIG_DIR) # logs/ is created in the working directory
+
+from app import load_settings
+load_settings(CONFIG_DIR)
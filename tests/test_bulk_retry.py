@@ -0,0 +1,89 @@
+import asyncio
+import json
+from typing import Dict, List, Optional
+
+import app.apis.es as es_api
+from app.model import EBulkResult, ESData, File, Source
+
+# elasticsearch answers from a script, bodies of every request are kept to check what was sent again
+
+
+class FakeResponse():
+    def __init__(self, status: int, data: Optional[Dict]) -> None:
+        self.status = status
+        self.data = data
+
+    async def json(self, loads=json.loads, content_type=None) -> Optional[Dict]:
+        if self.data is None:
+            raise ValueError('not json')
+        return self.data
+
+    async def __aenter__(self) -> 'FakeResponse':
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        pass
+
+
+class FakeSession():
+    def __init__(self, responses: List[FakeResponse]) -> None:
+        self.responses = responses
+        self.bodies: List[List[str]] = []
+
+    def post(self, url: str, headers: Dict, data: bytes, ssl=None) -> FakeResponse:
+        self.bodies.append([json.loads(line)['_id'] for line in data.decode('utf-8').splitlines()[1::2]])
+        return self.responses.pop(0)
+
+
+def items(statuses: Dict[str, int]) -> Dict:
+    return {'took': 1, 'errors': any(status != 201 for status in statuses.values())
+            , 'items': [{'index': {'_id': _id, 'status': status, **({'result': 'created'} if status == 201 else {'error': {}})}}
+                        for _id, status in statuses.items()]}
+
+
+def run_bulk(monkeypatch, responses: List[FakeResponse], n_items: int):
+    monkeypatch.setattr(es_api, 'BULK_INITIAL_BACKOFF', 0)
+    parsed = []
+    parse_bulk_result = es_api.parse_bulk_result
+    monkeypatch.setattr(es_api, 'parse_bulk_result', lambda data, *args: parsed.append(data) or parse_bulk_result(data, *args))
+    file = File('sap.xlsx', 'sap.xlsx', 0)
+    file.source = Source.SAP
+    body = b''.join(b'{"index":{}}\n' + json.dumps({'_id': str(i)}).encode('utf-8') + b'\n' for i in range(n_items))
+    session = FakeSession(responses)
+    bulk_result = asyncio.run(es_api.bulk.__wrapped__(ESData('http://es', {}, False, session), body, file, n_items))
+    return bulk_result, parsed[0], session.bodies
+
+
+def test_only_rejected_items_are_sent_again(monkeypatch):
+    bulk_result, data, bodies = run_bulk(monkeypatch, [
+        FakeResponse(200, items({'0': 201, '1': 429, '2': 201, '3': 503, '4': 201}))
+        ,FakeResponse(200, items({'1': 429, '3': 201}))
+        ,FakeResponse(200, items({'1': 201}))
+    ], 5)
+    assert bodies == [['0', '1', '2', '3', '4'], ['1', '3'], ['1']]
+    assert [(item['index']['_id'], item['index']['status']) for item in data['items']] == [(str(i), 201) for i in range(5)]
+    assert bulk_result.status == EBulkResult.INDEXED
+    assert bulk_result.n_retries == 2
+
+
+def test_request_rejected_as_a_whole_is_sent_again(monkeypatch):
+    bulk_result, data, bodies = run_bulk(monkeypatch, [
+        FakeResponse(429, None) # e.g. html of a proxy
+        ,FakeResponse(200, items({'0': 201, '1': 503, '2': 201}))
+        ,FakeResponse(200, items({'1': 201}))
+    ], 3)
+    assert bodies == [['0', '1', '2'], ['0', '1', '2'], ['1']]
+    assert [item['index']['_id'] for item in data['items']] == ['0', '1', '2']
+    assert bulk_result.status == EBulkResult.INDEXED
+
+
+def test_items_still_rejected_after_the_last_retry_fail(monkeypatch):
+    monkeypatch.setattr(es_api, 'BULK_MAX_RETRIES', 1)
+    bulk_result, data, bodies = run_bulk(monkeypatch, [
+        FakeResponse(200, items({'0': 429, '1': 201}))
+        ,FakeResponse(200, items({'0': 429}))
+    ], 2)
+    assert bodies == [['0', '1'], ['0']]
+    assert [(item['index']['_id'], item['index']['status']) for item in data['items']] == [('0', 429), ('1', 201)]
+    assert bulk_result.status == EBulkResult.UNKNOWN
+    assert [_id for _id, _ in bulk_result.outcomes.failed] == ['0']
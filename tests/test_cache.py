@@ -0,0 +1,34 @@
+import pandas as pd
+
+import app.services.cache as cache
+from app.model import File, Source
+from app.services.cache import cache_workbook, get_cached_workbook
+
+NAN = float('nan')
+
+
+def test_cached_workbook_reads_back_as_parsed(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, 'CACHE_DIR', str(tmp_path))
+    # read_excel gives whole number floats as ints, so mixed int/float and str/number columns are common
+    df = pd.DataFrame({'Zákazka': [1000, 1001, 1002], 'Hodiny': [1, 2.5, NAN], 'Poznámka': ['#', 1, NAN]}, dtype=object)
+    df.columns = ['Zákazka', 'Hodiny', 'Zákazka'] # headers may repeat
+    expected = df.copy()
+    cache_workbook('key', File(str(tmp_path / 'sap.xlsx'), 'sap.xlsx', 0), df, Source.SAP)
+    pd.testing.assert_frame_equal(df, expected) # the frame being indexed is left as read
+
+    cached = get_cached_workbook('key')
+    assert cached is not None
+    cached_df, source = cached
+    assert source == Source.SAP
+    pd.testing.assert_frame_equal(cached_df, expected, check_dtype=False)
+    assert [type(value) for value in cached_df.iloc[:2, 1]] == [int, float]
+    assert [type(value) for value in cached_df.iloc[:2, 2]] == [str, int]
+
+
+def test_cached_workbook_restores_integers_of_float_columns(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, 'CACHE_DIR', str(tmp_path))
+    df = pd.DataFrame({'Zákazka': [1000, 1001, 1002], 'Hodiny': [1, 2.5, NAN]}, dtype=object)
+    cache_workbook('key', File(str(tmp_path / 'sap.xlsx'), 'sap.xlsx', 0), df, Source.SAP)
+    cached_df, _ = get_cached_workbook('key')
+    pd.testing.assert_frame_equal(cached_df, df, check_dtype=False)
+    assert [type(value) for value in cached_df['Hodiny'][:2]] == [int, float]
@@ -0,0 +1,23 @@
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import app.services.columnar as columnar
+from app.services.columnar import read_csv_file, read_parquet_file
+
+NA_CELLS = ['NA', 'N/A', 'null', 'None', 'nan', '<NA>', '#N/A', ' NA', 'na', '1', '']
+NA_EXPECTED = [None] * 7 + [' NA', 'na', 1, None]
+
+
+def test_csv_readers_agree_on_nulls(tmp_path, monkeypatch):
+    path = tmp_path / 'export.csv'
+    path.write_text('a;b\n' + ''.join(f'{cell};x\n' for cell in NA_CELLS), encoding='utf-8')
+    read_by_arrow = read_csv_file(str(path))[0].tolist()
+    monkeypatch.setattr(columnar, 'pa', None)
+    read_by_pandas = read_csv_file(str(path))[0].tolist()
+    assert read_by_arrow == read_by_pandas == ['a'] + NA_EXPECTED
+
+
+def test_parquet_strings_use_excel_nulls(tmp_path):
+    path = str(tmp_path / 'export.parquet')
+    pq.write_table(pa.table({'a': NA_CELLS[:-2] + [None, '']}), path)
+    assert read_parquet_file(path)['a'].tolist() == NA_EXPECTED[:-2] + [None, None]
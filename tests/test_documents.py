@@ -0,0 +1,163 @@
+import os
+from datetime import datetime as dt, timedelta
+from typing import Any, Dict, List, Tuple
+
+import openpyxl
+import pandas as pd
+import pytest
+
+from app.apis.utils.documents import normalize_frame
+from app.model import NA_STRINGS, NORMALIZER_FIELD, NULL_VALUES, VALIDATOR_FIELD, File, Source
+from app.services.reader import get_df_with_source, get_frames_with_source
+
+# documents of normalize_frame must stay identical to the ones the original per-row code produced,
+# the reference functions below are that code, kept verbatim apart from names
+
+def reference_sap_analyzer_validator(row: Dict) -> bool:
+    try:
+        if int(row.get('Total no notifs', 0)) == 1: return True
+        else: return False
+    except:
+        return False
+
+
+def reference_vas_normalizer(field_name: str, field_value: Any) -> Any:
+    DATE_FIELDS = ['Time', 'Prebratie SAP', 'Prebratie terminál', 'Uzatvorenie SAP', 'Ukoncenie VAS', ]
+    try:
+        if field_name in DATE_FIELDS and \
+            (isinstance(field_value, float) or isinstance(field_name, int)):
+                days = int(field_value)
+                fraction = field_value - days
+                seconds = round(fraction * 86400)
+                return (dt(1900, 1, 1) + timedelta(days=days - 2, seconds=seconds)).isoformat()
+        else: return field_value
+    except:
+        return None
+
+
+def reference_normalize_row(row: Dict, normalizer: Any) -> Dict:
+    normalized_row = {}
+    for key, value in row.items():
+        if value in NULL_VALUES or pd.isnull(value) or pd.isna(value):
+            value = None
+        elif isinstance(value, pd.Timestamp) or isinstance(value, dt):
+            value = value.isoformat()
+        elif normalizer:
+            value = normalizer(key, value)
+        normalized_row[' '.join(key.strip().split())] = value
+    return normalized_row
+
+
+def reference_documents(df: pd.DataFrame, file: File, validator: Any, normalizer: Any) -> List:
+    documents = []
+    for row in df.to_dict(orient='records'):
+        _id = row.get(file.id_field, None)
+        if not _id or pd.isna(_id): continue
+        if validator is not None and not validator(row): continue
+        documents.append((str(_id), reference_normalize_row(row, normalizer)))
+    return documents
+
+
+def write_workbook(path: str, rows: List[List]) -> File:
+    wb = openpyxl.Workbook()
+    for row in rows:
+        wb.active.append(row)
+    wb.save(path)
+    return File(path, os.path.basename(path), 0)
+
+
+def read_documents(file: File) -> Tuple[pd.DataFrame, List]:
+    df, source = get_df_with_source(file)
+    file.source, file.id_field = source, source.value.get('_id')
+    file.row_validator = source.value.get(VALIDATOR_FIELD, None)
+    file.normalizer = source.value.get(NORMALIZER_FIELD, None)
+    return df, list(normalize_frame(df, file))
+
+
+MICROSECONDS = dt(2023, 5, 1, 1, 2, 3, 456000)
+
+WORKBOOKS = {
+    'sap': [
+        ['Zákazka', 'Kr.text', ' Koniec  poruchy ', 'Začiatok poruchy', 'Poznámka']
+        ,[1000, 'text', dt(2023, 1, 1, 10), MICROSECONDS, '#']
+        ,[1001, '#', None, dt(2023, 1, 2), 'note']
+        ,['#', 'hash id', dt(2023, 1, 3), 'not a date', 1.5]
+        ,[None, 'no id', dt(2023, 1, 4), None, None]
+        ,[0, 'zero id', dt(2023, 1, 5), None, 2.0]
+        ,['A-7', 'text id', '2023-01-06', dt(1950, 1, 1), True]
+    ]
+    ,'vas': [
+        ['Údržbárska zákazka', 'Popis poruchy', 'VAS číslo', 'Stroj', 'Time', 'Prebratie SAP', 'Ukoncenie VAS', 'Stav']
+        ,[2000, 'p', 1, 'S1', 45000.5, 45001.25, '#', '10%']
+        ,[2001, 'p', 2, 'S1', 45000, 45000.999999, 'text', None]
+        ,[2002, 'p', 3, 'S2', -1.5, 1e7, dt(2023, 3, 16), '#']
+        ,[2003, 'p', 4, 'S2', 0.0, None, 45001.0, 1.5]
+    ]
+    ,'sap_analyzer': [
+        ['Maintenance Order', 'Maintenance Order (Desc)', 'Employee', 'Company ID-EMP', 'Total no notifs']
+        ,[3000, 'd', 'E', 'C', 1]
+        ,[3001, 'd', 'E', 'C', ' 1 ']
+        ,[3002, 'd', 'E', 'C', '1.0']
+        ,[3003, 'd', 'E', 'C', True]
+        ,[3004, 'd', 'E', 'C', 1.9]
+        ,[3005, 'd', 'E', 'C', '#']
+        ,[3006, 'd', 'E', 'C', None]
+        ,[3007, 'd', 'E', 'C', 2]
+        ,[3008, 'd', 'E', 'C', '1']
+        ,[3009, 'd', 'E', 'C', 'x']
+        ,[3010, 'd', 'E', 'C', 1.0]
+    ]
+}
+REFERENCE_CALLABLES = {
+    'sap': (None, None)
+    ,'vas': (None, reference_vas_normalizer)
+    ,'sap_analyzer': (reference_sap_analyzer_validator, None)
+}
+
+
+@pytest.mark.parametrize('name', WORKBOOKS)
+def test_documents_match_reference(tmp_path, name):
+    file = write_workbook(str(tmp_path / f'{name}.xlsx'), WORKBOOKS[name])
+    df, documents = read_documents(file)
+    validator, normalizer = REFERENCE_CALLABLES[name]
+    assert documents == reference_documents(df, file, validator, normalizer)
+    assert documents # every workbook has valid rows
+
+
+def test_documents_keep_types(tmp_path):
+    file = write_workbook(str(tmp_path / 'sap.xlsx'), WORKBOOKS['sap'])
+    _, documents = read_documents(file)
+    assert file.source == Source.SAP
+    assert [_id for _id, _ in documents] == ['1000', '1001', '#', 'A-7']
+    first = documents[0][1]
+    assert first['Koniec poruchy'] == '2023-01-01T10:00:00'
+    assert first['Začiatok poruchy'] == '2023-05-01T01:02:03.456000'
+    assert first['Poznámka'] is None
+
+
+def test_streaming_reader_matches_pandas_reader(tmp_path):
+    rows = WORKBOOKS['sap'] + [[1002, text, None, None, text] for text in ('NA', 'N/A', 'null', 'None', 'nan', '<NA>', '#N/A', ' NA', 'na')]
+    file = write_workbook(str(tmp_path / 'sap.xlsx'), rows)
+    _, documents = read_documents(file)
+    frames, _ = get_frames_with_source(file)
+    streamed = [document for df in frames for document in normalize_frame(df, file)]
+    assert streamed == documents
+    assert [document['Kr_text'] for _, document in documents[-9:]] == [None] * 7 + [' NA', 'na']
+
+
+def test_header_detected_like_read_excel(tmp_path):
+    # openpyxl pads the header row to the widest row of the sheet, read_excel does not
+    file = write_workbook(str(tmp_path / 'sap.xlsx'), [['Zákazka', 'Kr.text'], [1000, 'a', 'no header'], [1001, None]])
+    df, source = get_df_with_source(file)
+    expected = pd.read_excel(file.path, header=None, dtype=object, skiprows=1).reindex(columns=range(2))
+    expected.columns = ['Zákazka', 'Kr_text']
+    assert source == Source.SAP
+    pd.testing.assert_frame_equal(df, expected)
+
+
+def test_na_strings_match_read_excel(tmp_path):
+    # NA_STRINGS is a copy of pandas' defaults, read_excel is what every reader has to agree with
+    texts = sorted(NA_STRINGS - {''}) + ['NA ', 'Null', '#', 'x']
+    file = write_workbook(str(tmp_path / 'na.xlsx'), [['text']] + [[text] for text in texts])
+    read = pd.read_excel(file.path, dtype=object)['text'].tolist()
+    assert {text for text, value in zip(texts, read) if pd.isna(value)} == NA_STRINGS - {''}
@@ -0,0 +1,35 @@
+import openpyxl
+
+import app.services.es as es
+import app.services.ledger as ledger
+import app.services.scanner as scanner
+import app.services.spool as spool
+from app.model import SPOOL_MODE, EFileStatus
+from app.services.es import bulk_files_to_es, close_es_connections
+from app.services.spool import list_spooled_files
+
+# the configured elasticsearch host is unreachable (conftest), like on a conversion box
+
+
+def test_spool_always_without_es(tmp_path, monkeypatch):
+    work_dir = tmp_path / 'export'
+    work_dir.mkdir()
+    wb = openpyxl.Workbook()
+    for row in [['Zákazka', 'Kr.text', 'Koniec poruchy'], [1000, 'a', None], [1001, 'b', None]]:
+        wb.active.append(row)
+    wb.save(work_dir / 'sap.xlsx')
+    monkeypatch.setattr(scanner, 'WORK_DIR', str(work_dir))
+    monkeypatch.setattr(scanner, 'SPOOL', SPOOL_MODE.ALWAYS)
+    monkeypatch.setattr(es, 'SPOOL', SPOOL_MODE.ALWAYS)
+    monkeypatch.setattr(ledger, 'LEDGER_PATH', str(tmp_path / 'files.sqlite'))
+    monkeypatch.setattr(spool, 'SPOOL_DIR', str(tmp_path / 'spool'))
+    monkeypatch.setattr(spool, 'SPOOLED_BY_PATH', None)
+    try:
+        assert bulk_files_to_es() is True
+    finally:
+        close_es_connections()
+    spooled = list_spooled_files()
+    assert [meta['path'] for meta in spooled] == [str(work_dir / 'sap.xlsx')]
+    assert sum(n for _, _, n in spooled[0]['batches']) == 2
+    assert ledger.get_file_states()[str(work_dir / 'sap.xlsx')][3] == EFileStatus.SPOOLED
+    assert not ledger.is_ledger_bootstrapped() # reconciled by the box which replays the spool